@@ -1,18 +1,24 @@
 import os
 import shutil
+import hashlib
+import json
 import psutil  # Add for memory monitoring
 import gc
 import time  # Add for performance monitoring
 from flask import Flask, request, jsonify, send_file
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
-import uuid
 import tempfile
 from typing import Dict, List, Tuple, Optional
 import logging
 from dotenv import load_dotenv
 
-from paint_processor import PaintByNumbersProcessor
+from artifact import JobArtifact
+from paint_processor import PaintByNumbersProcessor, default_num_threads
+from scheduler import AdmissionError, MemoryScheduler, available_memory_mb, fitted_size, image_dimensions
+from upload_index import ImageTooLargeError, UploadIndex
+from quality import (TIER_NAMES, TIER_ONLY_KNOBS, CostModel, job_features, parse_time_budget, plan_quality,
+                     predict_seconds, requested_tier)
 
 # Load environment variables
 load_dotenv()
@@ -23,6 +29,9 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
+# Predicts processing time for latency-budget quality tiers; recalibrated by every job
+cost_model = CostModel.from_env()
+
 # Memory monitoring function
 def get_memory_usage():
     """Get current memory usage."""
@@ -82,6 +91,8 @@ def after_request(response):
 UPLOAD_FOLDER = 'uploads'
 OUTPUT_FOLDER = 'outputs'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
+MAX_VARIANTS = 8  # Palette sizes returned by one multi-variant /api/process call
+RERENDER_OUTPUTS = ('template', 'reference', 'solution')
 
 # Create directories if they don't exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
@@ -91,6 +102,14 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['OUTPUT_FOLDER'] = OUTPUT_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
+# Deduplicated uploads plus their metadata (SQLite, in the upload folder by default)
+upload_index = UploadIndex(UPLOAD_FOLDER, os.getenv('UPLOAD_INDEX_PATH'),
+                           max_pixels=int(os.getenv('MAX_UPLOAD_PIXELS') or 0) or None)
+
+# Memory-aware admission control for /api/process; reservations are shared
+# by every worker on the box through a SQLite file next to the upload index
+scheduler = MemoryScheduler.from_env(os.path.join(UPLOAD_FOLDER, 'admission.sqlite3'))
+
 @app.after_request
 def after_request(response):
     """Add CORS headers to all responses."""
@@ -122,6 +141,63 @@ def allowed_file(filename: str) -> bool:
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def store_outputs(output_files: Dict[str, str], prefix: str) -> Dict[str, str]:
+    """Copy processor temp outputs into the output folder as <prefix>_<file_type>."""
+    result_files = {}
+    for file_type, temp_path in output_files.items():
+        if temp_path and os.path.exists(temp_path):
+            output_filename = f"{prefix}_{file_type}"
+            output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
+            
+            # Copy file to output directory instead of moving
+            shutil.copy2(temp_path, output_path)
+            
+            # Clean up temp file
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            
+            result_files[file_type] = output_filename
+    return result_files
+
+def parse_variant_counts(settings: Dict) -> Optional[List[int]]:
+    """Validate the optional num_colors_variants setting; returns None when absent."""
+    variants = settings.get('num_colors_variants')
+    if variants is None:
+        return None
+    if not isinstance(variants, list) or not variants or len(variants) > MAX_VARIANTS:
+        raise ValueError(f'num_colors_variants must be a list of 1-{MAX_VARIANTS} palette sizes')
+    if not all(isinstance(v, int) and 2 <= v <= 64 for v in variants):
+        raise ValueError('num_colors_variants entries must be integers between 2 and 64')
+    return sorted(set(variants))
+
+def parse_edge_threshold(settings: Dict) -> float:
+    """Validate settings['edge_threshold'], the intensity step smoothing keeps as an edge."""
+    threshold = settings.get('edge_threshold')
+    if isinstance(threshold, bool) or not isinstance(threshold, (int, float)) or not 0 < threshold <= 255:
+        raise ValueError('edge_threshold must be a number greater than 0 and at most 255')
+    return threshold
+
+def parse_render_style(style: Dict, num_colors: int) -> Dict:
+    """Validate a re-render style; returns only the keys that were given."""
+    if not isinstance(style, dict):
+        raise ValueError('style must be an object')
+    parsed = {}
+    if style.get('line_width') is not None:
+        if not isinstance(style['line_width'], int) or not 0 <= style['line_width'] <= 10:
+            raise ValueError('line_width must be an integer between 0 and 10')
+        parsed['line_width'] = style['line_width']
+    if style.get('label_scale') is not None:
+        if not isinstance(style['label_scale'], (int, float)) or not 0.25 <= style['label_scale'] <= 4:
+            raise ValueError('label_scale must be between 0.25 and 4')
+        parsed['label_scale'] = float(style['label_scale'])
+    if style.get('highlight_color') is not None:
+        if not isinstance(style['highlight_color'], int) or not 1 <= style['highlight_color'] <= num_colors:
+            raise ValueError(f'highlight_color must be a color number between 1 and {num_colors}')
+        parsed['highlight_color'] = style['highlight_color']
+    return parsed
+
 @app.route('/')
 def index():
     """Root route for basic info."""
@@ -132,6 +208,8 @@ def index():
             'health': '/api/health',
             'upload': '/api/upload',
             'process': '/api/process',
+            'rerender': '/api/rerender',
+            'thumbnail': '/api/thumbnail/<file_id>',
             'download': '/api/download/<file_id>/<file_type>',
             'settings': '/api/settings'
         }
@@ -165,6 +243,8 @@ def debug_memory():
         
         return jsonify({
             'memory_before_gc': memory_stats,
+            'available_mb': round(available_memory_mb(), 1),
+            'admission_budget_mb': scheduler.budget_mb(),
             'memory_after_gc': memory_after_gc,
             'memory_saved_mb': round(memory_stats['rss_mb'] - memory_after_gc['rss_mb'], 2),
             'timestamp': '2025-01-16T12:00:00Z'
@@ -192,22 +272,29 @@ def upload_file():
             return jsonify({'error': 'No selected file'}), 400
         
         if file and allowed_file(file.filename):
-            # Generate unique filename
             filename = secure_filename(file.filename)
-            unique_id = str(uuid.uuid4())
-            file_ext = filename.rsplit('.', 1)[1].lower()
-            unique_filename = f"{unique_id}.{file_ext}"
             
-            # Save uploaded file
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-            file.save(filepath)
+            # Store the bytes once per content hash; each upload gets its own file_id
+            try:
+                record = upload_index.add(file.read(), filename)
+            except ImageTooLargeError as e:
+                logger.warning(f"Rejected upload {filename}: {str(e)}")
+                return jsonify({'error': f'Image is too large (max {upload_index.max_pixels // 1_000_000} megapixels)'}), 400
+            except ValueError as e:
+                logger.warning(f"Rejected upload {filename}: {str(e)}")
+                return jsonify({'error': 'Invalid image file'}), 400
             
-            logger.info(f"File uploaded: {unique_filename}")
+            logger.info(f"File uploaded: {record.file_id} ({'duplicate' if record.duplicate else 'new'})")
             
             return jsonify({
                 'message': 'File uploaded successfully',
-                'file_id': unique_id,
-                'filename': filename
+                'file_id': record.file_id,
+                'filename': filename,
+                'width': record.width,
+                'height': record.height,
+                'format': record.format,
+                'size_bytes': record.size_bytes,
+                'duplicate': record.duplicate
             }), 200
         else:
             return jsonify({'error': 'File type not allowed'}), 400
@@ -249,42 +336,88 @@ def process_image():
             'output_format': 'svg'
         }
         
-        # Merge with provided settings
+        # Merge with provided settings; tier knobs only come from the quality plan
         process_settings = {**default_settings, **settings}
+        for knob in TIER_ONLY_KNOBS:
+            process_settings.pop(knob, None)
+        
+        try:
+            variant_counts = parse_variant_counts(process_settings)
+            parse_time_budget(process_settings)
+            requested_tier(process_settings)
+            parse_edge_threshold(process_settings)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        # Find input file
+        # Find input file: indexed uploads carry their dimensions, files stored
+        # before the index existed are found by extension
         input_file = None
-        for ext in ['png', 'jpg', 'jpeg', 'gif', 'bmp']:
-            potential_file = os.path.join(app.config['UPLOAD_FOLDER'], f"{file_id}.{ext}")
-            if os.path.exists(potential_file):
-                input_file = potential_file
-                break
+        dimensions = None
+        record = upload_index.get(file_id)
+        if record is not None:
+            input_file = record.path
+            dimensions = (record.width, record.height)
+        else:
+            for ext in ['png', 'jpg', 'jpeg', 'gif', 'bmp']:
+                potential_file = os.path.join(app.config['UPLOAD_FOLDER'], f"{secure_filename(file_id)}.{ext}")
+                if os.path.exists(potential_file):
+                    input_file = potential_file
+                    break
         
         if not input_file:
             return jsonify({'error': 'Input file not found'}), 404
         
-        # Process the image
-        processor = PaintByNumbersProcessor()
-        output_files = processor.process_image(input_file, process_settings)
-        
-        # Move output files to output directory
-        result_files = {}
-        for file_type, temp_path in output_files.items():
-            if temp_path and os.path.exists(temp_path):
-                output_filename = f"{file_id}_{file_type}"
-                output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
-                
-                # Copy file to output directory instead of moving
-                import shutil
-                shutil.copy2(temp_path, output_path)
+        # Admit the job at the largest processing size memory allows right now
+        dimensions = dimensions or image_dimensions(input_file) or scheduler.max_size
+        # Multi-variant jobs cluster once at their largest palette size
+        clustered_colors = max(variant_counts or [process_settings['num_colors']])
+        mobile = process_settings.get('mobile_optimized', False)
+        # Stop queueing while the job can still finish inside the worker timeout
+        expected_seconds = predict_seconds(cost_model, dimensions,
+                                           fitted_size(dimensions[0], dimensions[1], scheduler.size_cap(mobile)),
+                                           process_settings, variants=len(variant_counts or [1]),
+                                           num_colors=clustered_colors)
+        try:
+            with scheduler.admit(dimensions[0], dimensions[1],
+                                 num_colors=clustered_colors,
+                                 variants=len(variant_counts or [1]),
+                                 mobile=mobile,
+                                 threads=default_num_threads(),
+                                 queue_timeout=scheduler.queue_timeout_for(
+                                     time.time() - start_time + expected_seconds)) as plan:
+                process_settings['max_image_size'] = list(plan.max_image_size)
                 
-                # Clean up temp file
-                try:
-                    os.remove(temp_path)
-                except OSError:
-                    pass
+                # Turn quality knobs down to fit the client's time budget or tier
+                quality = plan_quality(cost_model, dimensions,
+                                       fitted_size(dimensions[0], dimensions[1], plan.max_image_size),
+                                       process_settings, variants=len(variant_counts or [1]),
+                                       num_colors=clustered_colors,
+                                       spent_seconds=time.time() - start_time,
+                                       min_size=scheduler.min_size)
+                if quality is not None:
+                    process_settings.update(quality.knobs)
                 
-                result_files[file_type] = output_filename
+                # Process the image
+                processor = PaintByNumbersProcessor()
+                variant_files = None
+                if variant_counts:
+                    # Multi-variant mode: one clustering pass shared by every palette size
+                    variants = processor.process_variants(input_file, process_settings, variant_counts)
+                    variant_files = {
+                        str(count): store_outputs(files, f"{file_id}_k{count}")
+                        for count, files in variants.items()
+                    }
+                    # The requested num_colors (or the largest variant) is the primary result
+                    primary = process_settings['num_colors'] if process_settings['num_colors'] in variants else variant_counts[-1]
+                    result_files = variant_files[str(primary)]
+                else:
+                    output_files = processor.process_image(input_file, process_settings)
+                    
+                    # Move output files to output directory
+                    result_files = store_outputs(output_files, file_id)
+        except AdmissionError as e:
+            logger.warning(f"Job rejected: {str(e)}")
+            return jsonify({'error': 'Server is busy, please try again shortly'}), 503
         
         logger.info(f"Image processed: {file_id}")
         
@@ -293,39 +426,126 @@ def process_image():
         processing_time = round(end_time - start_time, 2)
         end_memory = get_memory_usage()
         
+        # Feed the measured stage timings back into the cost model
+        if processor.processed_size is not None:
+            cost_model.observe(job_features(processor.decoded_size, process_settings, processor.processed_size,
+                                            num_colors=clustered_colors),
+                               processor.stage_timings)
+        
         # Force garbage collection after processing to free memory
         gc.collect()
         
-        return jsonify({
+        response = {
             'message': 'Image processed successfully',
             'file_id': file_id,
             'output_files': result_files,
             'settings_used': process_settings,
+            'admission': plan.to_dict(),
             'performance': {
                 'processing_time_seconds': processing_time,
                 'memory_before_mb': start_memory['rss_mb'],
                 'memory_after_mb': end_memory['rss_mb'],
                 'memory_used_mb': round(end_memory['rss_mb'] - start_memory['rss_mb'], 2)
             }
-        }), 200
+        }
+        if variant_files is not None:
+            response['variants'] = variant_files
+        if processor.matched_paints:
+            response['paints'] = {str(count): paints for count, paints in processor.matched_paints.items()}
+        if quality is not None:
+            quality.actual_seconds = processing_time
+            response['quality'] = quality.to_dict()
+        
+        return jsonify(response), 200
         
     except Exception as e:
         logger.error(f"Processing error: {str(e)}")
         return jsonify({'error': f'Processing failed: {str(e)}'}), 500
 
+@app.route('/api/thumbnail/<file_id>', methods=['GET'])
+def get_thumbnail(file_id):
+    """Small JPEG preview of an upload, generated once at upload time."""
+    thumbnail = upload_index.thumbnail(file_id)
+    if thumbnail is None:
+        return jsonify({'error': 'File not found'}), 404
+    response = app.response_class(thumbnail, mimetype='image/jpeg')
+    response.headers['Cache-Control'] = 'public, max-age=86400'
+    return response
+
+@app.route('/api/rerender', methods=['POST', 'OPTIONS'])
+def rerender_outputs():
+    """Re-render a processed job's outputs with a different style from its saved artifact."""
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'preflight'})
+    
+    try:
+        data = request.get_json()
+        
+        if not data or 'file_id' not in data:
+            return jsonify({'error': 'File ID required'}), 400
+        
+        # Multi-variant jobs keep one artifact per palette size
+        prefix = secure_filename(str(data['file_id']))
+        variant = data.get('variant')
+        if variant is not None:
+            if not isinstance(variant, int) or not 2 <= variant <= 64:
+                return jsonify({'error': 'variant must be an integer between 2 and 64'}), 400
+            prefix = f"{prefix}_k{variant}"
+        artifact_path = os.path.join(app.config['OUTPUT_FOLDER'], f"{prefix}_artifact.npz")
+        if not os.path.exists(artifact_path):
+            return jsonify({'error': 'Job artifact not found'}), 404
+        
+        outputs = data.get('outputs', list(RERENDER_OUTPUTS))
+        if not isinstance(outputs, list) or not outputs or not set(outputs) <= set(RERENDER_OUTPUTS):
+            return jsonify({'error': f'outputs must be a list of {", ".join(RERENDER_OUTPUTS)}'}), 400
+        
+        start_time = time.time()
+        artifact = JobArtifact.load(artifact_path)
+        try:
+            style = parse_render_style(data.get('style') or {}, len(artifact.palette))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        # Same style, same file names: repeated requests just overwrite identical files
+        style_tag = hashlib.md5(json.dumps(style, sort_keys=True).encode()).hexdigest()[:8]
+        processor = PaintByNumbersProcessor()
+        try:
+            output_files = processor.rerender(artifact, outputs, style)
+            result_files = store_outputs(output_files, f"{prefix}_{style_tag}")
+        finally:
+            shutil.rmtree(processor.temp_dir, ignore_errors=True)
+        
+        logger.info(f"Re-rendered {prefix} with style {style}")
+        
+        return jsonify({
+            'message': 'Outputs re-rendered successfully',
+            'file_id': data['file_id'],
+            'output_files': result_files,
+            'style': style,
+            'performance': {
+                'processing_time_seconds': round(time.time() - start_time, 3),
+                'stage_timings': processor.stage_timings
+            }
+        }), 200
+        
+    except Exception as e:
+        logger.error(f"Re-render error: {str(e)}")
+        return jsonify({'error': f'Re-render failed: {str(e)}'}), 500
+
 @app.route('/download/<filename>', methods=['GET'])
 def download_file(filename):
     """Download a generated file."""
     try:
-        # Ensure the file exists in the output folder
-        file_path = os.path.join(app.config['OUTPUT_FOLDER'], filename)
+        # Ensure the file exists in the output folder. send_file resolves relative
+        # paths against the app root, so make it absolute from the working directory
+        file_path = os.path.abspath(os.path.join(app.config['OUTPUT_FOLDER'], filename))
         if not os.path.exists(file_path):
             return jsonify({'error': 'File not found'}), 404
 
         # Return the file with proper headers
         response = send_file(
             file_path,
-            mimetype='image/png',
+            mimetype='application/octet-stream' if filename.endswith('.npz') else 'image/png',
             as_attachment=True,
             download_name=filename
         )
@@ -348,12 +568,15 @@ def get_default_settings():
         'num_colors': 15,
         'blur_amount': 2,
         'edge_threshold': 50,
+        'smoothing': 'edge_preserving',
         'min_area': 50,
         'output_format': 'svg',
         'color_options': [5, 10, 15, 20, 25, 30],
         'blur_options': [0, 1, 2, 3, 4, 5],
         'edge_options': [10, 25, 50, 75, 100],
-        'area_options': [50, 100, 200, 500, 1000]
+        'area_options': [50, 100, 200, 500, 1000],
+        'smoothing_options': ['edge_preserving', 'gaussian'],
+        'quality_options': TIER_NAMES
     }), 200
 
 if __name__ == '__main__':
@@ -0,0 +1,82 @@
+import json
+from dataclasses import dataclass, field
+from typing import Any, Dict, List
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ARTIFACT_VERSION = 1
+
+# One row per region: palette index (0-based), pixel area, bounding box
+# (exclusive x1/y1) and where its number label goes
+REGION_STATS_DTYPE = np.dtype([
+    ('region', np.uint32),
+    ('color', np.uint16),
+    ('area', np.uint32),
+    ('x0', np.int32),
+    ('y0', np.int32),
+    ('x1', np.int32),
+    ('y1', np.int32),
+    ('label_x', np.int32),
+    ('label_y', np.int32),
+    ('font_scale', np.float32),
+])
+
+
+@dataclass
+class JobArtifact:
+    """
+    Everything needed to re-render a job's outputs without quantizing or
+    segmenting again.
+
+    Saved as a compressed .npz (zlib): palette, per-pixel palette index,
+    uint16 region map (uint32 only if a job has more than 65535 regions),
+    the region stats table, the settings the job ran with and the catalog
+    paints matched to the palette (if any).
+    """
+    palette: np.ndarray        # (K, 3) uint8 RGB
+    color_map: np.ndarray      # (H, W) palette index of every pixel
+    region_map: np.ndarray     # (H, W) region id, 0 where no region was kept
+    region_stats: np.ndarray   # REGION_STATS_DTYPE, one row per region
+    settings: Dict[str, Any] = field(default_factory=dict)
+    paints: List[Dict[str, Any]] = field(default_factory=list)
+
+    def reduced_image(self) -> np.ndarray:
+        """The color-reduced RGB image."""
+        return self.palette[self.color_map]
+
+    def save(self, path: str) -> None:
+        region_dtype = np.uint16 if self.region_map.max(initial=0) <= np.iinfo(np.uint16).max else np.uint32
+        color_dtype = np.uint8 if len(self.palette) <= 256 else np.uint16
+        # np.savez_compressed appends .npz unless given a file object
+        with open(path, 'wb') as f:
+            np.savez_compressed(
+                f,
+                version=np.array(ARTIFACT_VERSION),
+                palette=self.palette.astype(np.uint8),
+                color_map=self.color_map.astype(color_dtype),
+                region_map=self.region_map.astype(region_dtype),
+                region_stats=self.region_stats,
+                settings=np.array(json.dumps(self.settings, default=str)),
+                paints=np.array(json.dumps(self.paints)),
+            )
+
+    @classmethod
+    def load(cls, path: str) -> 'JobArtifact':
+        """
+        Raises:
+            ValueError: if the file is not a job artifact this version can read
+        """
+        with np.load(path, allow_pickle=False) as data:
+            if 'version' not in data or int(data['version']) != ARTIFACT_VERSION:
+                raise ValueError(f"Unsupported job artifact: {path}")
+            return cls(
+                palette=data['palette'],
+                color_map=data['color_map'],
+                region_map=data['region_map'],
+                region_stats=data['region_stats'],
+                settings=json.loads(str(data['settings'])),
+                paints=json.loads(str(data['paints'])) if 'paints' in data else [],
+            )
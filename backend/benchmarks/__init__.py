@@ -0,0 +1 @@
+"""Benchmarks for the Paint by Numbers backend. Run from the backend directory."""
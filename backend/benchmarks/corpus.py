@@ -0,0 +1,120 @@
+"""
+Deterministic synthetic image corpus for benchmarks.
+
+Every image is generated locally from a fixed seed, so the same name and size
+always produce the same pixels and benchmark runs are comparable across
+machines and commits.
+"""
+import os
+from typing import Callable, Dict, List, Tuple
+
+import cv2
+import numpy as np
+
+SIZES: Dict[str, Tuple[int, int]] = {
+    'small': (320, 240),
+    'medium': (640, 480),
+    'large': (1280, 960),
+}
+
+
+def gradient(width: int, height: int, seed: int = 0) -> np.ndarray:
+    """Smooth linear and radial gradients - many nearly identical colors."""
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    cx, cy = width * 0.6, height * 0.4
+    radial = np.sqrt((x - cx) ** 2 + (y - cy) ** 2) / np.hypot(width, height)
+    image = np.stack([
+        255 * x / width,
+        255 * y / height,
+        255 * (1 - radial),
+    ], axis=2)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def noise(width: int, height: int, seed: int = 0) -> np.ndarray:
+    """High-frequency noise - worst case for region segmentation."""
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+
+def cartoon(width: int, height: int, seed: int = 0) -> np.ndarray:
+    """Flat cartoon art - a few solid shapes with hard edges."""
+    rng = np.random.default_rng(seed)
+    palette = rng.integers(0, 256, (8, 3)).tolist()
+    image = np.full((height, width, 3), palette[0], dtype=np.uint8)
+    scale = min(width, height)
+    for i in range(24):
+        color = palette[1 + i % 7]
+        if i % 3 == 0:
+            center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+            cv2.circle(image, center, int(rng.integers(scale // 20, scale // 5)), color, -1)
+        elif i % 3 == 1:
+            p1 = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+            p2 = (p1[0] + int(rng.integers(scale // 10, scale // 3)), p1[1] + int(rng.integers(scale // 10, scale // 3)))
+            cv2.rectangle(image, p1, p2, color, -1)
+        else:
+            points = np.stack([rng.integers(0, width, 3), rng.integers(0, height, 3)], axis=1).astype(np.int32)
+            cv2.fillPoly(image, [points], color)
+    return image
+
+
+def portrait(width: int, height: int, seed: int = 0) -> np.ndarray:
+    """Portrait-like image - shaded face over a soft background with fine noise."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    image = np.stack([
+        60 + 80 * y / height,
+        90 + 60 * x / width,
+        140 + 40 * (1 - y / height),
+    ], axis=2)
+
+    cx, cy = width / 2, height * 0.52
+    ax, ay = width * 0.22, height * 0.34
+    # Hair: a larger dark ellipse behind the face
+    hair = ((x - cx) / (ax * 1.25)) ** 2 + ((y - cy + ay * 0.15) / (ay * 1.15)) ** 2 <= 1
+    image[hair] = (50, 35, 25)
+
+    # Face: skin tone shaded from the upper left
+    face_dist = ((x - cx) / ax) ** 2 + ((y - cy) / ay) ** 2
+    face = face_dist <= 1
+    light = 1.0 - 0.35 * np.clip((x - cx + y - cy) / (ax + ay), -1, 1)
+    skin = np.stack([225 * light, 180 * light, 150 * light], axis=2)
+    image[face] = skin[face]
+
+    # Eyes and mouth
+    eye_r = max(2, int(min(width, height) * 0.025))
+    for ex in (cx - ax * 0.4, cx + ax * 0.4):
+        eye = (x - ex) ** 2 + (y - (cy - ay * 0.2)) ** 2 <= eye_r ** 2
+        image[eye] = (30, 30, 40)
+    mouth = (((x - cx) / (ax * 0.4)) ** 2 + ((y - (cy + ay * 0.45)) / (ay * 0.08)) ** 2) <= 1
+    image[mouth] = (170, 70, 70)
+
+    image += rng.normal(0, 6, image.shape)
+    image = np.clip(image, 0, 255).astype(np.uint8)
+    return cv2.GaussianBlur(image, (3, 3), 0)
+
+
+GENERATORS: Dict[str, Callable[[int, int, int], np.ndarray]] = {
+    'gradient': gradient,
+    'noise': noise,
+    'cartoon': cartoon,
+    'portrait': portrait,
+}
+
+
+def generate(name: str, size: str, seed: int = 0) -> np.ndarray:
+    """Generate one corpus image as an RGB array."""
+    width, height = SIZES[size]
+    return GENERATORS[name](width, height, seed)
+
+
+def write_corpus(directory: str, names: List[str], sizes: List[str]) -> Dict[Tuple[str, str], str]:
+    """Write corpus images as PNG files and return their paths keyed by (name, size)."""
+    os.makedirs(directory, exist_ok=True)
+    paths = {}
+    for name in names:
+        for size in sizes:
+            path = os.path.join(directory, f"{name}_{size}.png")
+            cv2.imwrite(path, cv2.cvtColor(generate(name, size), cv2.COLOR_RGB2BGR))
+            paths[(name, size)] = path
+    return paths
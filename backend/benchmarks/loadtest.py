@@ -0,0 +1,323 @@
+"""
+Local load test for the Flask API.
+
+Starts the app under gunicorn on a free local port (in a scratch directory, so
+uploads and outputs never touch the repo) and drives the full
+upload -> process -> download flow with synthetic corpus images.
+
+Two load models:
+- closed loop (default): --concurrency clients each run flows back to back
+- open loop: --rate flows/second arrive as a Poisson process, with at most
+  --concurrency in flight (arrivals beyond that wait, and the wait counts
+  towards their latency)
+
+Reports throughput, p50/p95/p99 latency per phase, error and timeout rates,
+and the RSS curve of every gunicorn worker sampled while the test runs.
+
+Usage (from the backend directory):
+    python -m benchmarks.loadtest --concurrency 4 --requests 20
+    python -m benchmarks.loadtest --rate 0.5 --duration 60 --workers 2 --json load.json
+"""
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import cv2
+import psutil
+
+from benchmarks.corpus import GENERATORS, SIZES, generate
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PHASES = ['upload', 'process', 'download', 'total']
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    # Nearest-rank percentile
+    ordered = sorted(values)
+    index = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+    return round(ordered[index], 3)
+
+
+class Server:
+    """A gunicorn instance serving app:app from a scratch directory."""
+
+    def __init__(self, workers: int, threads: int, timeout: int, preload: bool):
+        self.port = _free_port()
+        self.workdir = tempfile.mkdtemp(prefix='pbn_loadtest_')
+        env = dict(os.environ, PYTHONPATH=BACKEND_DIR, PORT=str(self.port),
+                   GUNICORN_PRELOAD='1' if preload else '0')
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn',
+             '-c', os.path.join(BACKEND_DIR, 'gunicorn.conf.py'),
+             '--bind', f'127.0.0.1:{self.port}',
+             '--workers', str(workers),
+             '--threads', str(threads),
+             '--timeout', str(timeout),
+             'app:app'],
+            cwd=self.workdir, env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        self.base_url = f'http://127.0.0.1:{self.port}'
+
+    def wait_ready(self, timeout: float = 60.0) -> None:
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError('gunicorn exited during startup')
+            try:
+                with urllib.request.urlopen(f'{self.base_url}/api/health', timeout=2):
+                    return
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.2)
+        raise RuntimeError(f'server not ready after {timeout}s')
+
+    def worker_pids(self) -> List[int]:
+        try:
+            return [child.pid for child in psutil.Process(self.process.pid).children()]
+        except psutil.NoSuchProcess:
+            return []
+
+    def stop(self) -> None:
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class RssMonitor:
+    """Sample RSS of every gunicorn worker on a background thread."""
+
+    def __init__(self, server: Server, interval: float):
+        self.server = server
+        self.interval = interval
+        self.samples: Dict[int, List[List[float]]] = {}
+        self._start = time.perf_counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            now = round(time.perf_counter() - self._start, 2)
+            for pid in self.server.worker_pids():
+                try:
+                    rss = psutil.Process(pid).memory_info().rss / 1024 / 1024
+                except psutil.NoSuchProcess:
+                    continue
+                self.samples.setdefault(pid, []).append([now, round(rss, 1)])
+            self._stop.wait(self.interval)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+class Client:
+    """Runs the upload -> process -> download flow against the server."""
+
+    def __init__(self, base_url: str, images: List[bytes], settings: Dict[str, Any], timeout: float):
+        self.base_url = base_url
+        self.images = images
+        self.settings = settings
+        self.timeout = timeout
+
+    def _request(self, path: str, data: Optional[bytes] = None, headers: Optional[Dict[str, str]] = None) -> bytes:
+        req = urllib.request.Request(f'{self.base_url}{path}', data=data, headers=headers or {})
+        with urllib.request.urlopen(req, timeout=self.timeout) as response:
+            return response.read()
+
+    def _upload(self, image: bytes) -> str:
+        boundary = uuid.uuid4().hex
+        body = (
+            f'--{boundary}\r\n'
+            'Content-Disposition: form-data; name="file"; filename="loadtest.png"\r\n'
+            'Content-Type: image/png\r\n\r\n'
+        ).encode() + image + f'\r\n--{boundary}--\r\n'.encode()
+        payload = self._request('/api/upload', body, {'Content-Type': f'multipart/form-data; boundary={boundary}'})
+        return json.loads(payload)['file_id']
+
+    def _process(self, file_id: str) -> Dict[str, str]:
+        body = json.dumps({'file_id': file_id, 'settings': self.settings}).encode()
+        payload = self._request('/api/process', body, {'Content-Type': 'application/json'})
+        return json.loads(payload)['output_files']
+
+    def run_flow(self, queued_at: float) -> Dict[str, Any]:
+        """Run one flow; latencies include any time spent queued before it started."""
+        result: Dict[str, Any] = {'ok': False, 'timeout': False, 'error': None}
+        image = random.choice(self.images)
+        try:
+            start = time.perf_counter()
+            file_id = self._upload(image)
+            uploaded = time.perf_counter()
+            output_files = self._process(file_id)
+            processed = time.perf_counter()
+            for filename in output_files.values():
+                self._request(f'/download/{filename}')
+            done = time.perf_counter()
+            result.update(ok=True, upload=uploaded - start, process=processed - uploaded,
+                          download=done - processed, total=done - queued_at)
+        except (socket.timeout, TimeoutError) as e:
+            result.update(timeout=True, error=str(e))
+        except urllib.error.URLError as e:
+            if isinstance(e.reason, (socket.timeout, TimeoutError)):
+                result.update(timeout=True, error=str(e))
+            else:
+                result['error'] = str(e)
+        except Exception as e:
+            result['error'] = str(e)
+        return result
+
+
+def run_load(client: Client, concurrency: int, requests: Optional[int], rate: Optional[float],
+             duration: Optional[float]) -> List[Dict[str, Any]]:
+    """Issue flows in the closed- or open-loop model and collect their results."""
+    futures = []
+    started = time.perf_counter()
+
+    def more() -> bool:
+        if requests is not None and len(futures) >= requests:
+            return False
+        if duration is not None and time.perf_counter() - started >= duration:
+            return False
+        return True
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        if rate:
+            # Open loop: Poisson arrivals, independent of how fast the server responds
+            next_arrival = time.perf_counter()
+            while more():
+                time.sleep(max(0.0, next_arrival - time.perf_counter()))
+                futures.append(pool.submit(client.run_flow, time.perf_counter()))
+                next_arrival += random.expovariate(rate)
+        else:
+            # Closed loop: keep exactly `concurrency` flows in flight
+            semaphore = threading.Semaphore(concurrency)
+            while more():
+                semaphore.acquire()
+                future = pool.submit(client.run_flow, time.perf_counter())
+                future.add_done_callback(lambda _: semaphore.release())
+                futures.append(future)
+        return [future.result() for future in futures]
+
+
+def summarize(results: List[Dict[str, Any]], elapsed: float, rss: Dict[int, List[List[float]]]) -> Dict[str, Any]:
+    ok = [r for r in results if r['ok']]
+    latency = {
+        phase: {f'p{pct}': _percentile([r[phase] for r in ok], pct) for pct in (50, 95, 99)}
+        for phase in PHASES
+    }
+    errors = [r['error'] for r in results if not r['ok'] and not r['timeout']]
+    return {
+        'flows': len(results),
+        'succeeded': len(ok),
+        'elapsed_s': round(elapsed, 2),
+        'throughput_per_s': round(len(ok) / elapsed, 3) if elapsed else 0.0,
+        'error_rate': round(len(errors) / len(results), 3) if results else 0.0,
+        'timeout_rate': round(sum(r['timeout'] for r in results) / len(results), 3) if results else 0.0,
+        'latency_s': latency,
+        'sample_errors': sorted(set(errors))[:5],
+        'worker_rss_mb': {
+            str(pid): {
+                'min': min(s[1] for s in samples),
+                'max': max(s[1] for s in samples),
+                'final': samples[-1][1],
+                'curve': samples,
+            }
+            for pid, samples in rss.items()
+        },
+    }
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    print(f"flows: {report['flows']}  succeeded: {report['succeeded']}  elapsed: {report['elapsed_s']}s")
+    print(f"throughput: {report['throughput_per_s']} flows/s  "
+          f"errors: {report['error_rate']:.1%}  timeouts: {report['timeout_rate']:.1%}")
+    print()
+    print(f"{'phase':<10} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for phase, stats in report['latency_s'].items():
+        cells = ''.join(f"{'-' if v is None else f'{v:.3f}s':>10}" for v in stats.values())
+        print(f"{phase:<10}{cells}")
+    print()
+    print(f"{'worker':<10} {'min':>9} {'max':>9} {'final':>9}")
+    for pid, stats in report['worker_rss_mb'].items():
+        print(f"{pid:<10} {stats['min']:>7.1f}MB {stats['max']:>7.1f}MB {stats['final']:>7.1f}MB")
+    for error in report['sample_errors']:
+        print(f"error: {error}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, default=2, help='maximum flows in flight')
+    parser.add_argument('--requests', type=int, help='stop after this many flows')
+    parser.add_argument('--duration', type=float, help='stop issuing flows after this many seconds')
+    parser.add_argument('--rate', type=float, help='open-loop arrival rate in flows/second')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--threads', type=int, default=1, help='gunicorn threads per worker')
+    parser.add_argument('--server-timeout', type=int, default=300, help='gunicorn worker timeout')
+    parser.add_argument('--no-preload', action='store_true', help='start gunicorn without preload_app')
+    parser.add_argument('--client-timeout', type=float, default=300.0, help='per-request client timeout')
+    parser.add_argument('--images', nargs='+', default=['portrait', 'cartoon'], choices=list(GENERATORS))
+    parser.add_argument('--size', default='medium', choices=list(SIZES))
+    parser.add_argument('--num-colors', type=int, default=15)
+    parser.add_argument('--min-area', type=int, default=50)
+    parser.add_argument('--rss-interval', type=float, default=0.5, help='seconds between RSS samples')
+    parser.add_argument('--json', help='write the full report (including RSS curves) to this file')
+    args = parser.parse_args()
+
+    if args.requests is None and args.duration is None:
+        args.requests = 10
+
+    random.seed(0)
+    images = [cv2.imencode('.png', cv2.cvtColor(generate(name, args.size), cv2.COLOR_RGB2BGR))[1].tobytes()
+              for name in args.images]
+
+    server = Server(args.workers, args.threads, args.server_timeout, not args.no_preload)
+    try:
+        server.wait_ready()
+        monitor = RssMonitor(server, args.rss_interval)
+        monitor.start()
+        client = Client(server.base_url, images,
+                        {'num_colors': args.num_colors, 'min_area': args.min_area}, args.client_timeout)
+        start = time.perf_counter()
+        results = run_load(client, args.concurrency, args.requests, args.rate, args.duration)
+        elapsed = time.perf_counter() - start
+        monitor.stop()
+    finally:
+        server.stop()
+
+    report = summarize(results, elapsed, monitor.samples)
+    report['config'] = vars(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+"""
+Micro and macro benchmarks for the processing pipeline.
+
+Runs PaintByNumbersProcessor.process_image over the synthetic corpus for a
+grid of image, size, num_colors and min_area. For every case it records the
+total wall time, the time of each pipeline stage (from
+processor.stage_timings), the peak traced allocation (NumPy/Python, via
+tracemalloc) and the peak process RSS.
+
+Results can be saved as a baseline; later runs compared against it flag any
+metric that got slower or bigger than the threshold.
+
+Usage (from the backend directory):
+    python -m benchmarks.pipeline --quick
+    python -m benchmarks.pipeline --save-baseline benchmarks/baseline.json
+    python -m benchmarks.pipeline --baseline benchmarks/baseline.json --threshold 0.25
+    python -m benchmarks.pipeline --save-cost-model cost_model.json
+"""
+import argparse
+import itertools
+import json
+import logging
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import Any, Dict, List
+
+import cv2
+import numpy as np
+import psutil
+
+from benchmarks.corpus import GENERATORS, SIZES, write_corpus
+from paint_processor import PaintByNumbersProcessor
+from quality import CostModel, job_features
+
+# Stages faster than this in the baseline are too noisy to flag
+MIN_FLAGGED_SECONDS = 0.005
+
+FULL_GRID = {
+    'images': list(GENERATORS),
+    'sizes': list(SIZES),
+    'num_colors': [5, 15, 30],
+    'min_area': [50, 500],
+}
+
+QUICK_GRID = {
+    'images': list(GENERATORS),
+    'sizes': ['small'],
+    'num_colors': [15],
+    'min_area': [50],
+}
+
+
+class _RssSampler:
+    """Sample process RSS on a background thread and keep the peak."""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            time.sleep(self.interval)
+
+    def __enter__(self) -> '_RssSampler':
+        self.peak = self.process.memory_info().rss
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+
+def run_case(input_path: str, settings: Dict[str, Any], repeats: int) -> Dict[str, Any]:
+    """Benchmark one grid case and return median timings and peak memory."""
+    totals: List[float] = []
+    stages: Dict[str, List[float]] = {}
+    peak_traced = 0
+    peak_rss = 0
+    features: Dict[str, float] = {}
+
+    # Timed runs go without tracemalloc (it slows allocation-heavy stages);
+    # one extra traced run measures peak NumPy/Python allocation
+    for run in range(repeats + 1):
+        traced = run == repeats
+        # k-means seeding and pixel sampling are random; pin them for repeatability
+        np.random.seed(0)
+        cv2.setRNGSeed(0)
+        processor = PaintByNumbersProcessor()
+
+        if traced:
+            tracemalloc.start()
+        with _RssSampler() as rss:
+            start = time.perf_counter()
+            processor.process_image(input_path, settings)
+            elapsed = time.perf_counter() - start
+        peak_rss = max(peak_rss, rss.peak)
+        shutil.rmtree(processor.temp_dir, ignore_errors=True)
+
+        if traced:
+            peak_traced = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            continue
+
+        features = job_features(processor.decoded_size, settings, processor.processed_size)
+        totals.append(elapsed)
+        for stage, seconds in processor.stage_timings.items():
+            stages.setdefault(stage, []).append(seconds)
+
+    return {
+        'total_s': round(statistics.median(totals), 4),
+        'stages_s': {stage: round(statistics.median(values), 4) for stage, values in stages.items()},
+        'peak_traced_mb': round(peak_traced / 1024 / 1024, 2),
+        'peak_rss_mb': round(peak_rss / 1024 / 1024, 2),
+        'features': features,
+    }
+
+
+def run_grid(grid: Dict[str, List], repeats: int) -> Dict[str, Dict[str, Any]]:
+    """Run every case in the grid; results are keyed image/size/k<colors>/a<min_area>."""
+    corpus_dir = tempfile.mkdtemp(prefix='pbn_corpus_')
+    try:
+        paths = write_corpus(corpus_dir, grid['images'], grid['sizes'])
+        results = {}
+        for image, size, num_colors, min_area in itertools.product(
+                grid['images'], grid['sizes'], grid['num_colors'], grid['min_area']):
+            key = f"{image}/{size}/k{num_colors}/a{min_area}"
+            # Process at the corpus size so the size axis measures the whole
+            # pipeline, not just decode and the resize down to the default cap
+            settings = {'num_colors': num_colors, 'min_area': min_area, 'blur_amount': 2,
+                        'max_image_size': list(SIZES[size])}
+            results[key] = run_case(paths[(image, size)], settings, repeats)
+            print(f"{key:<32} {results[key]['total_s']:>8.3f}s  "
+                  f"rss {results[key]['peak_rss_mb']:>7.1f}MB  "
+                  f"traced {results[key]['peak_traced_mb']:>6.1f}MB", flush=True)
+        return results
+    finally:
+        shutil.rmtree(corpus_dir, ignore_errors=True)
+
+
+def compare(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]], threshold: float) -> List[str]:
+    """Return a description of every metric that regressed beyond the threshold."""
+    regressions = []
+
+    def check(key: str, metric: str, current: float, previous: float, floor: float = 0.0) -> None:
+        if previous > floor and current > previous * (1 + threshold):
+            regressions.append(f"{key} {metric}: {previous} -> {current} (+{(current / previous - 1) * 100:.0f}%)")
+
+    for key, current in results.items():
+        previous = baseline.get(key)
+        if previous is None:
+            continue
+        check(key, 'total_s', current['total_s'], previous['total_s'], MIN_FLAGGED_SECONDS)
+        for stage, seconds in current['stages_s'].items():
+            check(key, stage, seconds, previous['stages_s'].get(stage, 0.0), MIN_FLAGGED_SECONDS)
+        check(key, 'peak_traced_mb', current['peak_traced_mb'], previous['peak_traced_mb'])
+        check(key, 'peak_rss_mb', current['peak_rss_mb'], previous['peak_rss_mb'])
+    return regressions
+
+
+def print_stage_table(results: Dict[str, Dict[str, Any]]) -> None:
+    """Print per-stage medians (milliseconds) for every case."""
+    stages = []
+    for result in results.values():
+        for stage in result['stages_s']:
+            if stage not in stages:
+                stages.append(stage)
+    short = [stage.replace('generate_', 'gen_') for stage in stages]
+    width = max([len(name) for name in short] + [10]) + 2
+    print()
+    print(f"{'case':<32}" + ''.join(f"{name:>{width}}" for name in short))
+    for key, result in results.items():
+        row = ''.join(f"{result['stages_s'].get(stage, 0.0) * 1000:>{width - 2}.1f}ms" for stage in stages)
+        print(f"{key:<32}{row}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--quick', action='store_true', help='small grid for a fast sanity check')
+    parser.add_argument('--images', nargs='+', choices=list(GENERATORS), help='override corpus images')
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), help='override image sizes')
+    parser.add_argument('--num-colors', nargs='+', type=int, help='override num_colors values')
+    parser.add_argument('--min-area', nargs='+', type=int, help='override min_area values')
+    parser.add_argument('--repeats', type=int, default=3, help='runs per case (median is reported)')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--save-baseline', help='write results as a baseline file')
+    parser.add_argument('--baseline', help='compare results against this baseline file')
+    parser.add_argument('--save-cost-model', help='fit the quality cost model to the results and write it here')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed relative regression (0.25 = 25%%)')
+    args = parser.parse_args()
+
+    # The processor logs every region at INFO; keep benchmark output readable
+    logging.basicConfig(level=logging.WARNING)
+
+    grid = dict(QUICK_GRID if args.quick else FULL_GRID)
+    for name, override in (('images', args.images), ('sizes', args.sizes),
+                           ('num_colors', args.num_colors), ('min_area', args.min_area)):
+        if override:
+            grid[name] = override
+
+    results = run_grid(grid, args.repeats)
+    print_stage_table(results)
+
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.save_cost_model:
+        coefficients = CostModel.fit([(result['features'], result['stages_s']) for result in results.values()])
+        with open(args.save_cost_model, 'w') as f:
+            json.dump(coefficients, f, indent=2, sort_keys=True)
+        print(f"\nCost model coefficients written to {args.save_cost_model}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        print()
+        if regressions:
+            print(f"{len(regressions)} regression(s) beyond {args.threshold:.0%}:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print(f"No regressions beyond {args.threshold:.0%} against {args.baseline}")
+
+
+if __name__ == '__main__':
+    main()
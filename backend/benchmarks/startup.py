@@ -0,0 +1,113 @@
+"""
+Cold-start benchmark for the backend.
+
+Every measurement runs in a fresh interpreter so nothing is cached between
+runs. Reports:
+
+- import_app: time to import the Flask app (what every cold worker pays
+  without preload)
+- warm_up: time spent in paint_processor.warm_up() (paid once in the
+  gunicorn master with preload)
+- first_job_cold: first process_image call in a fresh interpreter
+- first_job_warm: first process_image call after warm_up()
+
+Usage (from the backend directory):
+    python -m benchmarks.startup [--runs 5] [--json results.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, List
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_IMPORT_APP = """
+import time
+t0 = time.perf_counter()
+import app
+print(time.perf_counter() - t0)
+"""
+
+_WARM_UP = """
+import time
+import paint_processor
+t0 = time.perf_counter()
+paint_processor.warm_up()
+print(time.perf_counter() - t0)
+"""
+
+_FIRST_JOB = """
+import os, tempfile, time
+import cv2
+import numpy as np
+import paint_processor
+if {warm}:
+    paint_processor.warm_up()
+rng = np.random.default_rng(0)
+image = rng.integers(0, 255, (120, 160, 3), dtype=np.uint8)
+image = cv2.resize(cv2.resize(image, (16, 12)), (160, 120), interpolation=cv2.INTER_NEAREST)
+path = os.path.join(tempfile.mkdtemp(), 'input.png')
+cv2.imwrite(path, image)
+processor = paint_processor.PaintByNumbersProcessor()
+t0 = time.perf_counter()
+processor.process_image(path, {{'num_colors': 5, 'min_area': 20}})
+print(time.perf_counter() - t0)
+"""
+
+
+def _run_snippet(code: str) -> float:
+    """Run a snippet in a fresh interpreter and return the seconds it printed."""
+    result = subprocess.run(
+        [sys.executable, '-c', code],
+        cwd=BACKEND_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def _summarize(samples: List[float]) -> Dict[str, float]:
+    return {
+        'median_ms': round(statistics.median(samples) * 1000, 1),
+        'min_ms': round(min(samples) * 1000, 1),
+        'max_ms': round(max(samples) * 1000, 1),
+    }
+
+
+def run(runs: int) -> Dict[str, Dict[str, float]]:
+    """Run every startup measurement `runs` times."""
+    snippets = {
+        'import_app': _IMPORT_APP,
+        'warm_up': _WARM_UP,
+        'first_job_cold': _FIRST_JOB.format(warm=False),
+        'first_job_warm': _FIRST_JOB.format(warm=True),
+    }
+    return {
+        name: _summarize([_run_snippet(code) for _ in range(runs)])
+        for name, code in snippets.items()
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per measurement')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    results = run(args.runs)
+
+    print(f"{'measurement':<16} {'median':>10} {'min':>10} {'max':>10}")
+    for name, stats in results.items():
+        print(f"{name:<16} {stats['median_ms']:>8.1f}ms {stats['min_ms']:>8.1f}ms {stats['max_ms']:>8.1f}ms")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
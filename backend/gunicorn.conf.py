@@ -0,0 +1,59 @@
+"""
+Gunicorn configuration for the Paint by Numbers backend.
+
+Gunicorn picks this file up automatically when started from the backend
+directory, so `gunicorn app:app` (Render/Railway) and the Dockerfile command
+both run in startup-optimized mode:
+
+- the Flask app is imported once in the master process (preload_app)
+- the processor is warmed up in the master before any worker is forked
+- long-lived objects are frozen out of the garbage collector so forked
+  workers share those memory pages copy-on-write instead of duplicating them
+- each worker gets an even share of the CPUs for OpenCV and the processor's
+  thread pool (override with PROCESSING_THREADS)
+"""
+import gc
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+# Worker count and timeout keep gunicorn's defaults (WEB_CONCURRENCY workers,
+# 30s) unless configured; the Dockerfile passes its own on the command line
+if os.getenv('GUNICORN_TIMEOUT'):
+    timeout = int(os.getenv('GUNICORN_TIMEOUT'))
+
+# Load the app in the master and fork workers from it
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') != '0'
+
+
+def on_starting(server):
+    """
+    Export the real worker count (config file, WEB_CONCURRENCY or --workers)
+    so every worker sizes its thread pools from the same number, and the
+    worker timeout so admission never queues a job past it.
+    """
+    os.environ['WEB_CONCURRENCY'] = str(server.cfg.workers)
+    os.environ['GUNICORN_WORKER_TIMEOUT'] = str(server.cfg.timeout)
+
+
+def when_ready(server):
+    """Warm up the processor in the master before workers are spawned."""
+    if not preload_app:
+        return
+
+    from paint_processor import warm_up
+
+    warm_up()
+
+    # Move everything allocated so far into the permanent generation so the
+    # collector in each worker never touches (and un-shares) those pages
+    gc.collect()
+    gc.freeze()
+    server.log.info(f"Preloaded app, {gc.get_freeze_count()} objects frozen for copy-on-write sharing")
+
+
+def post_fork(server, worker):
+    """Share the CPUs between workers: cap OpenCV's own thread pool per worker."""
+    import cv2
+    from paint_processor import default_num_threads
+
+    cv2.setNumThreads(default_num_threads())
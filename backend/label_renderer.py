@@ -0,0 +1,152 @@
+import cv2
+import numpy as np
+from typing import Dict, Iterable, List, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+# Font scales are snapped to this step so a handful of atlas entries serve every label
+SCALE_STEP = 0.05
+
+# Sprite key: (quantized scale, fill thickness, outline thickness or 0)
+SpriteKey = Tuple[float, int, int]
+
+
+class Sprite:
+    """Pre-rendered label: anti-aliased coverage masks plus where the text origin sits."""
+
+    __slots__ = ('fill', 'outline', 'origin', 'text_size', 'inverse', '_tints')
+
+    def __init__(self, fill: np.ndarray, outline: Optional[np.ndarray], origin: Tuple[int, int], text_size: Tuple[int, int]):
+        self.fill = fill              # uint8 coverage of the text strokes
+        self.outline = outline        # uint8 coverage of the (thicker) outline strokes, or None
+        self.origin = origin          # (x, y) of the putText origin inside the sprite
+        self.text_size = text_size    # (w, h) as reported by cv2.getTextSize
+
+        # Outline then fill collapse into one blend: out = (pixel * inverse + tint) / 255,
+        # with inverse = 255 * (1 - a_outline) * (1 - a_fill)
+        fill_alpha = fill.astype(np.uint32)
+        outline_alpha = outline.astype(np.uint32) if outline is not None else np.zeros_like(fill_alpha)
+        # Stored per channel: broadcasting a single channel makes the blend several times slower
+        inverse = ((255 - outline_alpha) * (255 - fill_alpha) + 127) // 255
+        self.inverse = np.repeat(inverse[:, :, None], 3, axis=2)
+        self._tints: Dict[Tuple[Tuple[int, ...], Tuple[int, ...]], np.ndarray] = {}
+
+    def tint(self, text_color: Tuple[int, int, int], outline_color: Tuple[int, int, int]) -> np.ndarray:
+        """Premultiplied color term of the blend (scaled by 255, rounding offset included)."""
+        key = (tuple(text_color), tuple(outline_color))
+        tint = self._tints.get(key)
+        if tint is None:
+            fill_alpha = self.fill.astype(np.uint32)[:, :, None]
+            outline_alpha = (self.outline.astype(np.uint32)[:, :, None] if self.outline is not None
+                             else np.zeros_like(fill_alpha))
+            outline_term = np.uint32(outline_color) * outline_alpha * (255 - fill_alpha) // 255
+            tint = outline_term + np.uint32(text_color) * fill_alpha + 127
+            self._tints[key] = tint
+        return tint
+
+
+def quantize_scale(font_scale: float) -> float:
+    """Snap a font scale to the atlas grid."""
+    return round(round(font_scale / SCALE_STEP) * SCALE_STEP, 2)
+
+
+class GlyphAtlas:
+    """
+    Cache of pre-rendered label sprites.
+
+    Each label string (in practice the color numbers 1..num_colors) is rendered
+    once per (scale, thickness, outline) with the same Hershey font and LINE_AA
+    strokes cv2.putText uses. Whole numbers are cached rather than composed
+    from single digits because putText positions glyphs at sub-pixel offsets
+    that per-digit sprites cannot reproduce. Labels are then drawn by
+    alpha-compositing the cached coverage masks instead of rasterizing text.
+    Font scales are snapped to SCALE_STEP, so a label matches putText at the
+    snapped scale, not at an arbitrary one.
+    """
+
+    def __init__(self):
+        self._sprites: Dict[Tuple[str, SpriteKey], Sprite] = {}
+
+    @staticmethod
+    def _render(text: str, scale: float, thickness: int, outline: int) -> Sprite:
+        """Rasterize text into coverage masks with cv2.putText."""
+        (text_w, text_h), baseline = cv2.getTextSize(text, FONT, scale, thickness)
+        pad = max(thickness, outline) + 2
+        width = text_w + 2 * pad
+        height = text_h + baseline + 2 * pad
+        origin = (pad, pad + text_h)
+
+        fill = np.zeros((height, width), dtype=np.uint8)
+        cv2.putText(fill, text, origin, FONT, scale, 255, thickness, cv2.LINE_AA)
+        outline_mask = None
+        if outline:
+            outline_mask = np.zeros((height, width), dtype=np.uint8)
+            cv2.putText(outline_mask, text, origin, FONT, scale, 255, outline, cv2.LINE_AA)
+        return Sprite(fill, outline_mask, origin, (text_w, text_h))
+
+    def get(self, text: str, font_scale: float, thickness: int = 1, outline: int = 0) -> Sprite:
+        """Return the cached sprite for text, rendering it on first use."""
+        key = (quantize_scale(font_scale), thickness, outline)
+        sprite = self._sprites.get((text, key))
+        if sprite is None:
+            sprite = self._render(text, key[0], thickness, outline)
+            self._sprites[(text, key)] = sprite
+        return sprite
+
+    def preload(self, font_scales: Iterable[float], thickness: int = 1, outline: int = 0, max_number: int = 30) -> None:
+        """Pre-render the digits 0-9 and numbers up to max_number at the given scales."""
+        for font_scale in font_scales:
+            for number in range(0, max_number + 1):
+                self.get(str(number), font_scale, thickness, outline)
+
+    def draw(self, image: np.ndarray, labels: List[Tuple[str, Tuple[int, int], float]], thickness: int = 1,
+             outline: int = 0, text_color: Tuple[int, int, int] = (255, 255, 255),
+             outline_color: Tuple[int, int, int] = (0, 0, 0)) -> None:
+        """
+        Draw labels centred on their positions, in place.
+
+        Each label is (text, (cx, cy), font_scale) and is placed the way
+        cv2.putText would place it at (cx - w // 2, cy + h // 2), with the
+        font scale snapped to SCALE_STEP. Every sprite is blended in integer
+        math into its own clipped rectangle only, outline and fill in one
+        pass, in label order like successive putText calls.
+
+        Args:
+            image: RGB/BGR uint8 image to draw on
+            labels: (text, centre, font_scale) for every label
+            thickness: Stroke thickness of the text fill
+            outline: Stroke thickness of the outline drawn under the fill (0 for none)
+            text_color: Fill color
+            outline_color: Outline color
+        """
+        img_h, img_w = image.shape[:2]
+
+        for text, (cx, cy), font_scale in labels:
+            sprite = self.get(text, font_scale, thickness, outline)
+            text_w, text_h = sprite.text_size
+            # Top-left of the sprite in image coordinates
+            x0 = cx - text_w // 2 - sprite.origin[0]
+            y0 = cy + text_h // 2 - sprite.origin[1]
+            sprite_h, sprite_w = sprite.fill.shape
+
+            # Clip to the image
+            ix0, iy0 = max(x0, 0), max(y0, 0)
+            ix1, iy1 = min(x0 + sprite_w, img_w), min(y0 + sprite_h, img_h)
+            if ix0 >= ix1 or iy0 >= iy1:
+                continue
+            sx0, sy0 = ix0 - x0, iy0 - y0
+            sprite_box = (slice(sy0, sy0 + iy1 - iy0), slice(sx0, sx0 + ix1 - ix0))
+
+            roi = image[iy0:iy1, ix0:ix1]
+            blended = roi * sprite.inverse[sprite_box]
+            blended += sprite.tint(text_color, outline_color)[sprite_box]
+            blended //= 255
+            roi[:] = blended
+
+
+# Shared by every processor in the process; warmed in the gunicorn master so
+# forked workers inherit the pre-rendered sprites
+atlas = GlyphAtlas()
@@ -0,0 +1,182 @@
+import csv
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+import logging
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CATALOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'paints', 'base_paints.csv')
+
+# Parts of (first, second) paint in every two-paint mix added to the catalog
+MIX_RATIOS = ((1, 3), (1, 2), (1, 1), (2, 1), (3, 1))
+# Catalogs with more paints than this are used as listed, without mixes
+MAX_MIXED_PAINTS = 64
+# Bump when the index file layout or mixing model changes
+INDEX_VERSION = 1
+
+
+def rgb_to_lab(rgb: np.ndarray) -> np.ndarray:
+    """Convert uint8 RGB colors (N x 3) to CIELAB (L 0-100) as float64."""
+    rgb = np.asarray(rgb, dtype=np.float32).reshape(-1, 1, 3) / 255.0
+    return cv2.cvtColor(rgb, cv2.COLOR_RGB2LAB).reshape(-1, 3).astype(np.float64)
+
+
+def read_catalog(path: str) -> Tuple[List[str], List[str], np.ndarray]:
+    """
+    Read a paint catalog CSV with columns code, name, r, g, b.
+
+    Returns:
+        (codes, names, uint8 RGB array)
+    """
+    codes, names, colors = [], [], []
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            codes.append(row['code'].strip())
+            names.append(row['name'].strip())
+            colors.append((int(row['r']), int(row['g']), int(row['b'])))
+    if not codes:
+        raise ValueError(f"Paint catalog {path} is empty")
+    return codes, names, np.array(colors, dtype=np.uint8)
+
+
+def mix_paints(codes: List[str], names: List[str], rgb: np.ndarray) -> Tuple[List[str], List[str], np.ndarray]:
+    """
+    Add every two-paint mix at MIX_RATIOS to a catalog.
+
+    Mixes are approximated as the part-weighted geometric mean of the paints
+    in linear RGB, which behaves like subtractive (pigment) mixing: blue and
+    yellow give green, and any paint darkens a tint.
+    """
+    linear = (np.asarray(rgb, dtype=np.float64) / 255.0) ** 2.2
+    log_linear = np.log(np.maximum(linear, 1e-4))
+    mixed_codes, mixed_names, mixed_rgb = list(codes), list(names), [np.asarray(rgb, dtype=np.float64)]
+
+    first, second = np.triu_indices(len(codes), k=1)
+    for parts_a, parts_b in MIX_RATIOS:
+        weight = parts_a / (parts_a + parts_b)
+        mixed = np.exp(weight * log_linear[first] + (1 - weight) * log_linear[second])
+        mixed_rgb.append(np.clip(mixed ** (1 / 2.2) * 255.0, 0, 255))
+        for i, j in zip(first, second):
+            mixed_codes.append(f"{codes[i]}{parts_a}{codes[j]}{parts_b}")
+            mixed_names.append(f"{parts_a}x {names[i]} + {parts_b}x {names[j]}")
+
+    return mixed_codes, mixed_names, np.rint(np.concatenate(mixed_rgb)).astype(np.uint8)
+
+
+def _save_atomic(path: str, save) -> None:
+    """Write a file through a temporary name so readers never see a partial file."""
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'wb') as f:
+        save(f)
+    os.replace(temp_path, path)
+
+
+class PaintCatalog:
+    """
+    Paint catalog with a nearest-color index in CIELAB.
+
+    The expanded catalog (base paints plus mixes) is converted to LAB once
+    and saved as .npy files keyed by the catalog's content hash. Every
+    process memory-maps those files, so workers share one copy of the
+    catalog, and a KD-tree over the mapped LAB points (built in the gunicorn
+    master during warm-up) answers nearest-paint queries in microseconds.
+    """
+
+    def __init__(self, codes: List[str], names: List[str], rgb: np.ndarray, lab: np.ndarray):
+        from scipy.spatial import cKDTree
+
+        self.codes = codes
+        self.names = names
+        self.rgb = rgb
+        self.lab = lab
+        self._tree = cKDTree(lab)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @classmethod
+    def load(cls, path: str, index_dir: str) -> 'PaintCatalog':
+        """Open the index for a catalog CSV, building it first if this catalog has none yet."""
+        with open(path, 'rb') as f:
+            key = hashlib.sha1(f.read() + f"v{INDEX_VERSION}".encode()).hexdigest()[:16]
+        base = os.path.join(index_dir, f"paints_{key}")
+        lab_path, rgb_path, meta_path = f"{base}_lab.npy", f"{base}_rgb.npy", f"{base}.json"
+
+        if not all(os.path.exists(p) for p in (lab_path, rgb_path, meta_path)):
+            codes, names, rgb = read_catalog(path)
+            if len(codes) <= MAX_MIXED_PAINTS:
+                codes, names, rgb = mix_paints(codes, names, rgb)
+            os.makedirs(index_dir, exist_ok=True)
+            _save_atomic(lab_path, lambda f: np.save(f, rgb_to_lab(rgb)))
+            _save_atomic(rgb_path, lambda f: np.save(f, rgb))
+            _save_atomic(meta_path, lambda f: f.write(json.dumps({'codes': codes, 'names': names}).encode()))
+            logger.info(f"Built paint index for {path}: {len(codes)} paints in {index_dir}")
+
+        with open(meta_path) as f:
+            meta = json.load(f)
+        return cls(meta['codes'], meta['names'], np.load(rgb_path, mmap_mode='r'), np.load(lab_path, mmap_mode='r'))
+
+    def paint(self, index: int) -> Dict[str, Any]:
+        return {
+            'code': self.codes[index],
+            'name': self.names[index],
+            'rgb': [int(c) for c in self.rgb[index]],
+        }
+
+    def match_palette(self, palette: np.ndarray, weights: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Assign every palette color a different catalog paint.
+
+        Each color's nearest paints come from the KD-tree; the assignment
+        then minimizes the pixel-weighted total color difference (CIE76
+        delta E) over those candidates so no two colors share a paint.
+        Falls back to plain nearest paints if the palette is larger than
+        the catalog.
+
+        Args:
+            palette: uint8 RGB colors, one row per palette entry
+            weights: Pixels per palette entry (uniform if omitted)
+
+        Returns:
+            Catalog index for every palette entry
+        """
+        from scipy.optimize import linear_sum_assignment
+
+        lab = rgb_to_lab(palette)
+        if len(palette) > len(self):
+            return self._tree.query(lab, k=1)[1]
+
+        # Every color's K nearest paints: enough for a distinct assignment to exist
+        _, nearest = self._tree.query(lab, k=len(palette))
+        candidates = np.unique(np.asarray(nearest).reshape(len(palette), -1))
+        distances = np.linalg.norm(lab[:, None, :] - self.lab[candidates][None, :, :], axis=2)
+        if weights is not None:
+            # +1 so colors without pixels still get their nearest free paint
+            distances *= (np.asarray(weights, dtype=np.float64) + 1.0)[:, None]
+        rows, cols = linear_sum_assignment(distances)
+        return candidates[cols[np.argsort(rows)]]
+
+
+_catalog: Optional[PaintCatalog] = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog() -> PaintCatalog:
+    """
+    The process-wide catalog from PAINT_CATALOG_PATH, with its index in
+    PAINT_INDEX_DIR (default: a directory in the system temp dir).
+    """
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            path = os.getenv('PAINT_CATALOG_PATH') or DEFAULT_CATALOG_PATH
+            index_dir = os.getenv('PAINT_INDEX_DIR') or os.path.join(tempfile.gettempdir(), 'pbn_paint_index')
+            _catalog = PaintCatalog.load(path, index_dir)
+        return _catalog
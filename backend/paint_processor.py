@@ -1,40 +1,264 @@
 import cv2
 import numpy as np
-from PIL import Image, ImageDraw, ImageFont
-from sklearn.cluster import KMeans
-from skimage.measure import label, regionprops
-from skimage.segmentation import watershed
-from skimage.morphology import disk
-from scipy.spatial import distance
 import os
 import tempfile
 import gc  # Add garbage collection
-from typing import Dict, List, Tuple, Optional, Any
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple, Optional, Any
 import logging
 
+from artifact import REGION_STATS_DTYPE, JobArtifact
+from label_renderer import atlas, quantize_scale
+from paint_catalog import get_catalog
+
 logger = logging.getLogger(__name__)
 
+# Default processing size cap when no memory scheduler picks one per job
+DEFAULT_MAX_IMAGE_SIZE = (600, 450)
+MOBILE_MAX_IMAGE_SIZE = (500, 375)
+
+# Pixels assigned to their nearest k-means center per step
+ASSIGN_CHUNK_PIXELS = 16384
+
+# A job gets one thread per this many processed pixels, up to its thread budget,
+# so small jobs don't pay thread overhead or crowd out other jobs on the box
+PIXELS_PER_THREAD = 100000
+
+
+# K-means settings when no quality tier asks for more or less effort
+KMEANS_ITERATIONS = 3
+KMEANS_ATTEMPTS = 2
+
+# Edge-preserving smoothing: window radius per blur_amount step, and the
+# factor the filter coefficients are computed at below processing size
+SMOOTHING_RADIUS_PER_BLUR = 4
+SMOOTHING_DOWNSAMPLE = 2
+# Floor of the filter's regularization term, so a flat window never divides 0/0
+SMOOTHING_MIN_EPS = 1e-6
+
+
+def kmeans_sample_size(total_pixels: int, mobile_optimized: bool = False, sample_scale: float = 1.0) -> int:
+    """
+    Number of pixels k-means is fitted on; equals total_pixels when the image
+    is small enough to cluster every pixel.
+    """
+    # Mobile-specific ultra-aggressive sampling
+    if mobile_optimized:
+        threshold = 15000  # Much smaller threshold for mobile
+        max_sample = 10000  # Smaller max sample for mobile
+    else:
+        threshold = 25000
+        max_sample = 15000
+    
+    if total_pixels <= threshold:
+        return total_pixels
+    
+    # Mobile gets even smaller samples
+    if mobile_optimized:
+        if total_pixels > 100000:
+            sample_size = 8000   # Ultra-small for mobile large images
+        elif total_pixels > 50000:
+            sample_size = 10000  # Small for mobile medium images
+        else:
+            sample_size = min(12000, total_pixels // 2)
+    else:
+        if total_pixels > 200000:
+            sample_size = max_sample
+        elif total_pixels > 100000:
+            sample_size = 20000
+        else:
+            sample_size = min(25000, total_pixels // 3)
+    return max(1000, min(total_pixels, int(sample_size * sample_scale)))
+
+
+def edge_preserving_smooth(image: np.ndarray, radius: int, edge_threshold: float,
+                           downsample: int = SMOOTHING_DOWNSAMPLE) -> np.ndarray:
+    """
+    Flatten color variation inside regions while keeping edges sharp.
+
+    Fast self-guided filter (He & Sun, 2015) per channel: the local linear
+    coefficients are computed with box filters on a downsampled copy, then
+    upsampled and applied to the full-resolution image. Areas whose local
+    contrast is well below edge_threshold are averaged over the radius;
+    steps well above it are kept.
+
+    Args:
+        image: uint8 RGB image
+        radius: Smoothing window radius in full-resolution pixels
+        edge_threshold: Intensity step (0-255) treated as an edge
+        downsample: Factor the coefficients are computed at
+
+    Returns:
+        Smoothed uint8 RGB image
+    """
+    height, width = image.shape[:2]
+    downsample = max(1, min(downsample, radius))
+    guide = image.astype(np.float32) / 255.0
+    small = cv2.resize(guide, (max(1, width // downsample), max(1, height // downsample)),
+                       interpolation=cv2.INTER_AREA)
+
+    r = max(1, round(radius / downsample))
+    window = (2 * r + 1, 2 * r + 1)
+    mean = cv2.boxFilter(small, -1, window)
+    # Float rounding can leave flat windows with a tiny negative variance
+    variance = np.maximum(cv2.boxFilter(small * small, -1, window) - mean * mean, 0)
+    eps = max((edge_threshold / 255.0) ** 2, SMOOTHING_MIN_EPS)
+
+    a = variance / (variance + eps)
+    b = mean - a * mean
+    a = cv2.resize(cv2.boxFilter(a, -1, window), (width, height), interpolation=cv2.INTER_LINEAR)
+    b = cv2.resize(cv2.boxFilter(b, -1, window), (width, height), interpolation=cv2.INTER_LINEAR)
+
+    smoothed = (a * guide + b) * 255.0 + 0.5
+    return np.clip(smoothed, 0, 255).astype(np.uint8)
+
+
+def default_num_threads() -> int:
+    """
+    Threads one job may use: PROCESSING_THREADS if set, otherwise the CPU
+    count shared evenly between the gunicorn workers (WEB_CONCURRENCY, which
+    gunicorn.conf.py sets from the configured worker count).
+    """
+    configured = os.getenv('PROCESSING_THREADS')
+    if configured:
+        return max(1, int(configured))
+    workers = max(1, int(os.getenv('WEB_CONCURRENCY') or 1))
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+def warm_up() -> None:
+    """
+    Import lazily-loaded dependencies and initialise OpenCV once.
+
+    Called from the gunicorn preload hook so forked workers inherit a warm
+    interpreter instead of paying the import cost on their first request.
+    """
+    # scikit-image is only needed for label placement; import it here so the
+    # module is resident in the master process before workers are forked
+    from skimage.measure import regionprops  # noqa: F401
+
+    # Touch the OpenCV code paths used by every job (kmeans, labeling, contours)
+    sample = np.random.randint(0, 255, (32, 32, 3), dtype=np.uint8)
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 1, 1.0)
+    cv2.kmeans(np.float32(sample.reshape(-1, 3)), 2, None, criteria, 1, cv2.KMEANS_RANDOM_CENTERS)
+    mask = (sample[:, :, 0] > 127).astype(np.uint8)
+    cv2.connectedComponents(mask)
+    cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    cv2.imencode('.png', sample)
+
+    # Pre-render label sprites for the template and reference sheet font scales
+    atlas.preload([0.3, 0.35, 0.4, 0.45, 0.5], thickness=1, outline=2)
+    atlas.preload([1.2], thickness=3)
+
+    # Build (or map) the paint catalog index once so workers share it
+    try:
+        get_catalog()
+    except Exception as e:
+        logger.warning(f"Paint catalog unavailable: {str(e)}")
+    logger.info("Paint processor warmed up")
+
+
 class PaintByNumbersProcessor:
     """Main processor for generating paint-by-numbers from images."""
     
-    def __init__(self):
+    def __init__(self, num_threads: Optional[int] = None):
         self.temp_dir = tempfile.mkdtemp()
-        # EMERGENCY: Much smaller size to prevent memory crashes
-        self.max_image_size = (600, 450)  # Reduced from 1200x900
+        # Thread budget for independent per-color / per-region work and output encodes
+        self.num_threads = num_threads or default_num_threads()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pool_threads = 1
+        self._pending_writes: List[Tuple[str, Future]] = []
+        # Used when settings carry no per-job 'max_image_size'
+        self.max_image_size = DEFAULT_MAX_IMAGE_SIZE
+        # Wall-clock seconds per pipeline stage for the last process_image call
+        self.stage_timings: Dict[str, float] = {}
+        # (width, height) of the last input as decoded and as processed
+        self.decoded_size: Optional[Tuple[int, int]] = None
+        self.processed_size: Optional[Tuple[int, int]] = None
+        # Catalog paints matched to each palette size, when paint_catalog is on
+        self.matched_paints: Dict[int, List[Dict[str, Any]]] = {}
         
-    def _resize_if_needed(self, image: np.ndarray) -> np.ndarray:
+    @contextmanager
+    def _stage(self, name: str):
+        """Record how long a pipeline stage takes in self.stage_timings."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_timings[name] = round(time.perf_counter() - start, 4)
+        
+    @contextmanager
+    def _thread_pool(self, num_pixels: int):
+        """Run the enclosed stages with a thread pool sized for this job."""
+        threads = min(self.num_threads, max(1, num_pixels // PIXELS_PER_THREAD))
+        if threads <= 1:
+            yield
+            return
+        logger.info(f"Using {threads} threads")
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='pbn')
+        self._pool_threads = threads
+        try:
+            yield
+        finally:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            self._pool_threads = 1
+    
+    def _map(self, fn: Callable, items: List) -> List:
+        """Map fn over items on the job's thread pool (in order), or inline without one."""
+        if self._executor is None or len(items) <= 1:
+            return [fn(item) for item in items]
+        return list(self._executor.map(fn, items))
+    
+    def _chunks(self, items: List) -> List[List]:
+        """Split items into one contiguous batch per pool thread."""
+        if self._executor is None:
+            return [items]
+        size = max(1, -(-len(items) // self._pool_threads))
+        return [items[i:i + size] for i in range(0, len(items), size)]
+    
+    def _write_image(self, path: str, image: np.ndarray, settings: Dict[str, Any]) -> None:
+        """Encode and save an RGB image, in the background when a thread pool is active."""
+        params = []
+        if settings.get('png_compression') is not None:
+            params = [cv2.IMWRITE_PNG_COMPRESSION, int(settings['png_compression'])]
+        
+        def write() -> bool:
+            return cv2.imwrite(path, cv2.cvtColor(image, cv2.COLOR_RGB2BGR), params)
+        
+        if self._executor is None:
+            write()
+        else:
+            self._pending_writes.append((path, self._executor.submit(write)))
+    
+    def _flush_writes(self, output_files: Dict[str, str]) -> Dict[str, str]:
+        """Wait for background encodes and drop outputs that failed to save."""
+        failed = set()
+        for path, future in self._pending_writes:
+            try:
+                if not future.result():
+                    failed.add(path)
+            except Exception as e:
+                logger.error(f"Failed to write {path}: {str(e)}")
+                failed.add(path)
+        self._pending_writes = []
+        return {name: path for name, path in output_files.items() if path not in failed}
+    
+    def _resize_if_needed(self, image: np.ndarray, max_size: Optional[Tuple[int, int]] = None) -> np.ndarray:
         """Resize image if it's too large to save memory."""
         h, w = image.shape[:2]
-        max_w, max_h = self.max_image_size
+        max_w, max_h = max_size or self.max_image_size
         
-        # EMERGENCY: Always resize if larger than limit
+        # Always resize if larger than limit
         if w > max_w or h > max_h:
             # Calculate scaling factor
             scale = min(max_w / w, max_h / h)
             new_w = int(w * scale)
             new_h = int(h * scale)
             
-            logger.info(f"EMERGENCY RESIZE: {w}x{h} to {new_w}x{new_h}")
+            logger.info(f"Resizing: {w}x{h} to {new_w}x{new_h}")
             resized = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_AREA)
             
             # Force garbage collection
@@ -65,70 +289,99 @@ class PaintByNumbersProcessor:
         try:
             logger.info(f"Processing image: {input_path}")
             logger.info(f"Settings: {settings}")
+            self.stage_timings = {}
+            self.matched_paints = {}
             
             # Mobile-specific optimizations
             is_mobile = settings.get('mobile_optimized', False)
             
-            # Load and prepare image
-            image = cv2.imread(input_path)
-            if image is None:
-                raise ValueError(f"Could not load image from {input_path}")
-            
-            logger.info(f"Image loaded successfully. Shape: {image.shape}")
-            
-            # Convert BGR to RGB
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            
-            # Mobile optimization: more aggressive resizing
-            if is_mobile:
-                self.max_image_size = (500, 375)  # Even smaller for mobile
-                logger.info("Mobile optimization: Using smaller image size")
-            
-            # Resize if too large to save memory
-            image = self._resize_if_needed(image)
-            logger.info(f"After resize check. Shape: {image.shape}")
-            
-            # Apply blur if specified (reduced for mobile)
-            blur_amount = settings.get('blur_amount', 0)
-            if blur_amount > 0:
-                if is_mobile and blur_amount > 2:
-                    blur_amount = 2  # Limit blur for mobile performance
-                kernel_size = blur_amount * 2 + 1
-                image = cv2.GaussianBlur(image, (kernel_size, kernel_size), 0)
-                logger.info(f"Applied blur with kernel size: {kernel_size}")
+            image = self._prepare_image(input_path, settings)
             
             # Reduce colors (with mobile optimization)
             num_colors = settings.get('num_colors', 15)
             logger.info(f"Reducing colors to {num_colors}")
-            reduced_image, color_palette = self.reduce_colors(image, num_colors, is_mobile)
+            with self._stage('reduce_colors'):
+                reduced_image, color_palette = self.reduce_colors(image, num_colors, is_mobile, **self._kmeans_options(settings))
             
-            # Create regions (simplified for mobile)
-            logger.info("Creating regions...")
-            regions = self.create_regions(reduced_image, settings)
+            paints = None
+            if settings.get('paint_catalog'):
+                with self._stage('match_paints'):
+                    reduced_image, color_palette, paints = self.match_paints(image, reduced_image, color_palette)
+                self.matched_paints[num_colors] = paints
             
-            # Generate outputs
-            output_files = {}
+            with self._thread_pool(image.shape[0] * image.shape[1]):
+                output_files = self._generate_outputs(reduced_image, color_palette, settings, paints=paints)
             
-            # Generate numbered template
-            logger.info("Generating template...")
-            template_path = self.generate_template(regions, color_palette, settings, reduced_image)
-            if template_path:
-                output_files['template.png'] = template_path
+            logger.info(f"Processing completed. Generated {len(output_files)} files. Stage timings: {self.stage_timings}")
+            return output_files
+            
+        except Exception as e:
+            logger.error(f"Processing error: {str(e)}")
+            import traceback
+            logger.error(f"Traceback: {traceback.format_exc()}")
+            raise
+    
+    def process_variants(self, input_path: str, settings: Dict[str, Any], variant_counts: List[int]) -> Dict[int, Dict[str, str]]:
+        """
+        Process an image once for several palette sizes.
+        
+        The image is decoded, resized and blurred once and clustered once at the
+        largest palette size; smaller palettes are derived by hierarchically
+        merging those cluster centers, so only region labeling and rendering
+        repeat for each variant.
+        
+        Args:
+            input_path: Path to input image
+            settings: Processing settings (num_colors is ignored)
+            variant_counts: Palette sizes to generate
+            
+        Returns:
+            Dictionary of output file paths for each palette size
+        """
+        try:
+            logger.info(f"Processing image: {input_path} with palette sizes {variant_counts}")
+            logger.info(f"Settings: {settings}")
+            self.stage_timings = {}
+            self.matched_paints = {}
             
-            # Generate color reference
-            logger.info("Generating color reference...")
-            reference_path = self.generate_color_reference(color_palette, settings)
-            if reference_path:
-                output_files['reference.png'] = reference_path
+            is_mobile = settings.get('mobile_optimized', False)
+            counts = sorted(set(variant_counts))
             
-            # Generate solution
-            logger.info("Generating solution...")
-            solution_path = self.generate_solution(reduced_image, settings)
-            if solution_path:
-                output_files['solution.png'] = solution_path
+            image = self._prepare_image(input_path, settings)
             
-            logger.info(f"Processing completed. Generated {len(output_files)} files")
-            return output_files
+            # Cluster once at the largest palette size and keep per-pixel assignments
+            with self._stage('reduce_colors'):
+                labels, centers = self._cluster_colors(image, counts[-1], is_mobile, **self._kmeans_options(settings))
+            
+            with self._stage('merge_palettes'):
+                weights = np.bincount(labels, minlength=len(centers))
+                merged = self.merge_color_centers(centers, weights, counts)
+            
+            variants = {}
+            with self._thread_pool(image.shape[0] * image.shape[1]):
+                for count in counts:
+                    variant_centers, mapping = merged[count]
+                    palette_centers = np.uint8(variant_centers)
+                    reduced_image = palette_centers[mapping[labels]].reshape(image.shape)
+                    color_palette = [(int(c[0]), int(c[1]), int(c[2])) for c in palette_centers]
+                    
+                    paints = None
+                    if settings.get('paint_catalog'):
+                        with self._stage(f'match_paints_k{count}'):
+                            reduced_image, color_palette, paints = self.match_paints(image, reduced_image, color_palette)
+                        self.matched_paints[count] = paints
+                
+                    output_dir = os.path.join(self.temp_dir, f"k{count}")
+                    os.makedirs(output_dir, exist_ok=True)
+                    logger.info(f"Rendering variant with {count} colors")
+                    variants[count] = self._generate_outputs(reduced_image, color_palette, settings,
+                                                             output_dir=output_dir, stage_suffix=f"_k{count}",
+                                                             paints=paints)
+                    del reduced_image
+            
+            self._cleanup_memory(labels, image)
+            logger.info(f"Processing completed. Generated {len(variants)} variants. Stage timings: {self.stage_timings}")
+            return variants
             
         except Exception as e:
             logger.error(f"Processing error: {str(e)}")
@@ -136,7 +389,174 @@ class PaintByNumbersProcessor:
             logger.error(f"Traceback: {traceback.format_exc()}")
             raise
     
-    def reduce_colors(self, image: np.ndarray, num_colors: int, mobile_optimized: bool = False) -> Tuple[np.ndarray, List[Tuple[int, int, int]]]:
+    def _kmeans_options(self, settings: Dict[str, Any]) -> Dict[str, Any]:
+        """K-means effort knobs from settings (set by quality tiers)."""
+        return {
+            'sample_scale': settings.get('kmeans_sample_scale', 1.0),
+            'iterations': settings.get('kmeans_iterations', KMEANS_ITERATIONS),
+            'attempts': settings.get('kmeans_attempts', KMEANS_ATTEMPTS),
+        }
+    
+    def _prepare_image(self, input_path: str, settings: Dict[str, Any]) -> np.ndarray:
+        """Load, resize and blur the input image; returns an RGB array."""
+        is_mobile = settings.get('mobile_optimized', False)
+        
+        # Load and prepare image
+        with self._stage('load'):
+            image = cv2.imread(input_path)
+            if image is None:
+                raise ValueError(f"Could not load image from {input_path}")
+            
+            logger.info(f"Image loaded successfully. Shape: {image.shape}")
+            self.decoded_size = (image.shape[1], image.shape[0])
+            
+            # Convert BGR to RGB
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        
+        # Processing size for this job: chosen by the memory scheduler when set,
+        # otherwise the processor default (smaller for mobile)
+        max_size = settings.get('max_image_size')
+        if max_size is None and is_mobile:
+            max_size = MOBILE_MAX_IMAGE_SIZE
+            logger.info("Mobile optimization: Using smaller image size")
+        
+        # Resize if too large to save memory
+        with self._stage('resize'):
+            image = self._resize_if_needed(image, tuple(max_size) if max_size else None)
+        logger.info(f"After resize check. Shape: {image.shape}")
+        self.processed_size = (image.shape[1], image.shape[0])
+        
+        # Smooth if specified: edge-preserving by default, plain Gaussian blur
+        # (reduced for mobile) when asked for
+        blur_amount = settings.get('blur_amount', 0)
+        if blur_amount > 0 and settings.get('smoothing', 'edge_preserving') != 'gaussian':
+            radius = int(blur_amount * SMOOTHING_RADIUS_PER_BLUR)
+            edge_threshold = settings.get('edge_threshold', 50)
+            with self._stage('blur'):
+                image = edge_preserving_smooth(image, radius, edge_threshold)
+            logger.info(f"Applied edge-preserving smoothing: radius {radius}, edge threshold {edge_threshold}")
+        elif blur_amount > 0:
+            if is_mobile and blur_amount > 2:
+                blur_amount = 2  # Limit blur for mobile performance
+            kernel_size = blur_amount * 2 + 1
+            with self._stage('blur'):
+                image = cv2.GaussianBlur(image, (kernel_size, kernel_size), 0)
+            logger.info(f"Applied blur with kernel size: {kernel_size}")
+        
+        return image
+    
+    def _generate_outputs(self, reduced_image: np.ndarray, color_palette: List[Tuple[int, int, int]],
+                          settings: Dict[str, Any], output_dir: Optional[str] = None,
+                          stage_suffix: str = '', paints: Optional[List[Dict[str, Any]]] = None) -> Dict[str, str]:
+        """Segment the color-reduced image and render template, reference and solution."""
+        # Create regions (simplified for mobile)
+        logger.info("Creating regions...")
+        with self._stage(f'create_regions{stage_suffix}'):
+            regions = self.create_regions(reduced_image, settings)
+        
+        # Generate outputs
+        output_files = {}
+        
+        # Generate numbered template
+        logger.info("Generating template...")
+        with self._stage(f'generate_template{stage_suffix}'):
+            color_map = self.color_index_map(reduced_image, color_palette)
+            region_stats = self.compute_region_stats(regions, color_map, len(color_palette))
+            template_path = self.generate_template(regions, color_palette, settings, reduced_image, output_dir,
+                                                   region_stats)
+        if template_path:
+            output_files['template.png'] = template_path
+        
+        # Generate color reference
+        logger.info("Generating color reference...")
+        with self._stage(f'generate_color_reference{stage_suffix}'):
+            reference_path = self.generate_color_reference(color_palette, settings, output_dir, paints=paints)
+        if reference_path:
+            output_files['reference.png'] = reference_path
+        
+        # Generate solution
+        logger.info("Generating solution...")
+        with self._stage(f'generate_solution{stage_suffix}'):
+            solution_path = self.generate_solution(reduced_image, settings, output_dir)
+        if solution_path:
+            output_files['solution.png'] = solution_path
+        
+        # Keep what re-rendering needs so style changes skip quantization and segmentation;
+        # then wait for any encodes still running on the thread pool
+        with self._stage(f'write_outputs{stage_suffix}'):
+            artifact = JobArtifact(np.asarray(color_palette, dtype=np.uint8).reshape(-1, 3), color_map, regions,
+                                   region_stats, settings, paints or [])
+            artifact_path = self.save_artifact(artifact, output_dir)
+            if artifact_path:
+                output_files['artifact.npz'] = artifact_path
+            output_files = self._flush_writes(output_files)
+        
+        return output_files
+    
+    def save_artifact(self, artifact: JobArtifact, output_dir: Optional[str] = None) -> Optional[str]:
+        """Save the job artifact; returns its path, or None if it could not be written."""
+        artifact_path = os.path.join(output_dir or self.temp_dir, 'artifact.npz')
+        try:
+            artifact.save(artifact_path)
+            return artifact_path
+        except Exception as e:
+            logger.error(f"Artifact save error: {str(e)}")
+            return None
+    
+    def rerender(self, artifact: JobArtifact, outputs: List[str], style: Dict[str, Any],
+                 output_dir: Optional[str] = None) -> Dict[str, str]:
+        """
+        Regenerate outputs from a job artifact with a different style.
+        
+        Quantization, segmentation and label placement are all read from the
+        artifact, so only drawing and encoding run again.
+        
+        Args:
+            artifact: Artifact saved by a previous job
+            outputs: Any of 'template', 'reference' and 'solution'
+            style: line_width, label_scale and/or highlight_color (see render_template)
+            output_dir: Directory to write to (defaults to the processor temp dir)
+            
+        Returns:
+            Dictionary of output file paths, keyed like process_image's
+        """
+        self.stage_timings = {}
+        settings = artifact.settings
+        color_palette = [tuple(int(c) for c in color) for color in artifact.palette]
+        reduced_image = artifact.reduced_image()
+        output_files = {}
+        
+        with self._thread_pool(artifact.region_map.size):
+            if 'template' in outputs:
+                with self._stage('generate_template'):
+                    template = self.render_template(reduced_image, artifact.region_map, artifact.region_stats,
+                                                    style, artifact.color_map)
+                    template_path = os.path.join(output_dir or self.temp_dir, 'template.png')
+                    self._write_image(template_path, template, settings)
+                output_files['template.png'] = template_path
+            
+            if 'reference' in outputs:
+                with self._stage('generate_color_reference'):
+                    reference_path = self.generate_color_reference(color_palette, settings, output_dir, style,
+                                                                   artifact.paints or None)
+                if reference_path:
+                    output_files['reference.png'] = reference_path
+            
+            if 'solution' in outputs:
+                with self._stage('generate_solution'):
+                    solution_path = self.generate_solution(reduced_image, settings, output_dir, style,
+                                                           artifact.color_map)
+                if solution_path:
+                    output_files['solution.png'] = solution_path
+            
+            with self._stage('write_outputs'):
+                output_files = self._flush_writes(output_files)
+        
+        logger.info(f"Re-rendered {list(output_files)} from artifact. Stage timings: {self.stage_timings}")
+        return output_files
+    
+    def reduce_colors(self, image: np.ndarray, num_colors: int, mobile_optimized: bool = False,
+                      **kmeans_options: Any) -> Tuple[np.ndarray, List[Tuple[int, int, int]]]:
         """
         Reduce image colors using K-means clustering with mobile optimization.
         
@@ -144,41 +564,53 @@ class PaintByNumbersProcessor:
             image: Input image array
             num_colors: Number of colors to reduce to
             mobile_optimized: Whether to use mobile-specific optimizations
+            **kmeans_options: sample_scale/iterations/attempts passed to _cluster_colors
             
         Returns:
             Reduced image and color palette
         """
+        labels, centers = self._cluster_colors(image, num_colors, mobile_optimized, **kmeans_options)
+        
+        # Convert back to uint8
+        centers = np.uint8(centers)
+        
+        # Create reduced image
+        reduced_data = centers[labels]
+        reduced_image = reduced_data.reshape(image.shape)
+        
+        # Create color palette
+        color_palette = [(int(c[0]), int(c[1]), int(c[2])) for c in centers]
+        
+        # Clean up memory
+        self._cleanup_memory(reduced_data, labels)
+        
+        return reduced_image, color_palette
+    
+    def _cluster_colors(self, image: np.ndarray, num_colors: int, mobile_optimized: bool = False,
+                        sample_scale: float = 1.0, iterations: int = KMEANS_ITERATIONS,
+                        attempts: int = KMEANS_ATTEMPTS) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Cluster pixel colors with K-means.
+        
+        Args:
+            image: Input image array
+            num_colors: Number of clusters
+            mobile_optimized: Whether to use mobile-specific sampling
+            sample_scale: Multiplier on the k-means sample size (quality tiers)
+            iterations: Maximum k-means iterations per attempt
+            attempts: Number of k-means restarts
+            
+        Returns:
+            Flat per-pixel cluster labels and float32 cluster centers
+        """
         # Reshape image for clustering
-        original_shape = image.shape
-        h, w = original_shape[:2]
+        h, w = image.shape[:2]
         total_pixels = h * w
-        
-        # Mobile-specific ultra-aggressive sampling
-        if mobile_optimized:
-            threshold = 15000  # Much smaller threshold for mobile
-            max_sample = 10000  # Smaller max sample for mobile
-        else:
-            threshold = 25000
-            max_sample = 15000
+        sample_size = kmeans_sample_size(total_pixels, mobile_optimized, sample_scale)
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, iterations, 3.0)
         
         # Use ultra-aggressive sampling for memory safety
-        if total_pixels > threshold:
-            # Mobile gets even smaller samples
-            if mobile_optimized:
-                if total_pixels > 100000:
-                    sample_size = 8000   # Ultra-small for mobile large images
-                elif total_pixels > 50000:
-                    sample_size = 10000  # Small for mobile medium images
-                else:
-                    sample_size = min(12000, total_pixels // 2)
-            else:
-                if total_pixels > 200000:
-                    sample_size = max_sample
-                elif total_pixels > 100000:
-                    sample_size = 20000
-                else:
-                    sample_size = min(25000, total_pixels // 3)
-            
+        if sample_size < total_pixels:
             logger.info(f"{'MOBILE' if mobile_optimized else 'STANDARD'} SAMPLING: {sample_size} pixels from {total_pixels}")
             
             # Flatten and sample
@@ -187,38 +619,131 @@ class PaintByNumbersProcessor:
             sampled_data = np.float32(data[indices])
             
             # Ultra-fast K-means with minimal iterations
-            criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 3, 3.0)  # Only 3 iterations
-            _, _, centers = cv2.kmeans(sampled_data, num_colors, None, criteria, 2, cv2.KMEANS_RANDOM_CENTERS)
+            _, _, centers = cv2.kmeans(sampled_data, num_colors, None, criteria, attempts, cv2.KMEANS_RANDOM_CENTERS)
             
             # Clean up immediately
             del sampled_data, indices
             gc.collect()
             
-            # Fast assignment
-            data = np.float32(data)
-            labels = np.argmin(np.sum((data[:, None, :] - centers[None, :, :]) ** 2, axis=2), axis=1)
+            labels = self._assign_to_centers(data, centers)
             
         else:
             # Very small images - minimal processing
             data = image.reshape((-1, 3))
             data = np.float32(data)
-            criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 3, 3.0)
-            _, labels, centers = cv2.kmeans(data, num_colors, None, criteria, 2, cv2.KMEANS_RANDOM_CENTERS)
+            _, labels, centers = cv2.kmeans(data, num_colors, None, criteria, attempts, cv2.KMEANS_RANDOM_CENTERS)
         
-        # Convert back to uint8
-        centers = np.uint8(centers)
+        # Clean up memory
+        self._cleanup_memory(data)
         
-        # Create reduced image
-        reduced_data = centers[labels.flatten()]
-        reduced_image = reduced_data.reshape(original_shape)
+        return labels.flatten(), centers
+    
+    def _assign_to_centers(self, data: np.ndarray, centers: np.ndarray) -> np.ndarray:
+        """Label every pixel (rows of data) with its nearest center."""
+        centers = np.float32(centers)
+        # Fast assignment, in chunks so the pixel x center distance matrix
+        # stays a few MB instead of growing with the image
+        labels = np.empty(len(data), dtype=np.intp)
+        for start in range(0, len(data), ASSIGN_CHUNK_PIXELS):
+            chunk = np.float32(data[start:start + ASSIGN_CHUNK_PIXELS])
+            distances = np.sum((chunk[:, None, :] - centers[None, :, :]) ** 2, axis=2)
+            labels[start:start + ASSIGN_CHUNK_PIXELS] = np.argmin(distances, axis=1)
+        return labels
+    
+    def match_paints(self, image: np.ndarray, reduced_image: np.ndarray,
+                     color_palette: List[Tuple[int, int, int]]) -> Tuple[np.ndarray, List[Tuple[int, int, int]], List[Dict[str, Any]]]:
+        """
+        Snap the palette to distinct paints from the catalog and re-quantize.
         
-        # Create color palette
-        color_palette = [(int(c[0]), int(c[1]), int(c[2])) for c in centers]
+        Args:
+            image: The image the palette was clustered from
+            reduced_image: Color-reduced image
+            color_palette: Color palette
+            
+        Returns:
+            Re-quantized image, the paint colors as palette, and the matched paints
+        """
+        catalog = get_catalog()
+        palette = np.asarray(color_palette, dtype=np.uint8).reshape(-1, 3)
+        weights = np.bincount(self.color_index_map(reduced_image, color_palette).ravel(), minlength=len(palette))
+        indices = catalog.match_palette(palette, weights)
         
-        # Clean up memory
-        self._cleanup_memory(data, reduced_data, labels)
+        # Re-quantize from the source pixels: with the palette moved, some
+        # pixels are now closer to a different paint
+        paint_colors = np.array(catalog.rgb[indices], dtype=np.uint8)
+        labels = self._assign_to_centers(image.reshape(-1, 3), paint_colors)
+        reduced_image = paint_colors[labels].reshape(image.shape)
         
-        return reduced_image, color_palette
+        paints = [catalog.paint(i) for i in indices]
+        logger.info(f"Matched palette to paints: {[paint['code'] for paint in paints]}")
+        return reduced_image, [tuple(int(c) for c in color) for color in paint_colors], paints
+    
+    def merge_color_centers(self, centers: np.ndarray, weights: np.ndarray, target_counts: List[int]) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+        """
+        Derive smaller palettes by hierarchically merging cluster centers.
+        
+        Repeatedly merges the pair of centers whose merge least increases the
+        pixel-weighted squared error (Ward linkage), replacing them with their
+        weighted mean, and snapshots the palette at every requested size.
+        
+        Args:
+            centers: Float cluster centers, one row per color
+            weights: Number of pixels assigned to each center
+            target_counts: Palette sizes to produce (at most len(centers))
+            
+        Returns:
+            For each size, the merged centers and an index array mapping each
+            original center to its merged center
+        """
+        weights = np.asarray(weights, dtype=np.float64).copy()
+        merged = np.asarray(centers, dtype=np.float64).copy()
+        mapping = np.arange(len(centers), dtype=np.intp)
+        alive = np.ones(len(centers), dtype=bool)
+        results = {}
+        
+        def ward_costs(i: int, others: np.ndarray) -> np.ndarray:
+            """Cost of merging center i with each of others; empty clusters merge for free."""
+            total = weights[i] + weights[others]
+            distance = np.sum((merged[others] - merged[i]) ** 2, axis=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cost = weights[i] * weights[others] / total * distance
+            return np.where(total == 0, 0.0, cost)
+        
+        # Pairwise merge costs, upper triangle only (i < j); the rest stays inf
+        costs = np.full((len(centers), len(centers)), np.inf)
+        for i in range(len(centers) - 1):
+            costs[i, i + 1:] = ward_costs(i, np.arange(i + 1, len(centers)))
+        
+        def snapshot() -> None:
+            # Surviving centers keep their original order, as the palette indices
+            survivors = np.flatnonzero(alive)
+            new_index = np.zeros(len(centers), dtype=np.intp)
+            new_index[survivors] = np.arange(len(survivors))
+            results[len(survivors)] = (merged[survivors].astype(np.float32), new_index[mapping])
+        
+        remaining = len(centers)
+        for count in sorted(set(target_counts), reverse=True):
+            while remaining > count:
+                # Row-major argmin picks the first cheapest pair, as a pairwise scan would
+                i, j = np.unravel_index(np.argmin(costs), costs.shape)
+                total = weights[i] + weights[j]
+                if total:
+                    merged[i] = (merged[i] * weights[i] + merged[j] * weights[j]) / total
+                weights[i] = total
+                mapping[mapping == j] = i
+                alive[j] = False
+                costs[j, :] = np.inf
+                costs[:, j] = np.inf
+                remaining -= 1
+                
+                # Only pairs involving the merged center change
+                before = np.flatnonzero(alive[:i])
+                after = i + 1 + np.flatnonzero(alive[i + 1:])
+                costs[before, i] = ward_costs(i, before)
+                costs[i, after] = ward_costs(i, after)
+            snapshot()
+        
+        return results
     
     def create_regions(self, image: np.ndarray, settings: Dict[str, Any]) -> np.ndarray:
         """
@@ -241,35 +766,45 @@ class PaintByNumbersProcessor:
         height, width = image.shape[:2]
         regions = np.zeros((height, width), dtype=np.int32)
         
-        # Get unique colors in the image
+        # Get unique colors in the image, and each pixel's index into them
         image_2d = image.reshape(-1, 3)
-        unique_colors = np.unique(image_2d, axis=0)
+        unique_colors, color_index = np.unique(image_2d, axis=0, return_inverse=True)
+        color_index = color_index.reshape(height, width)
         
         logger.info(f"Found {len(unique_colors)} unique colors in the image")
         
         region_id = 1
         min_area = settings.get('min_area', 100)
         
-        for color in unique_colors:
-            # Create mask for this color
-            mask = np.all(image == color, axis=2).astype(np.uint8)
-            
-            # Find connected components for this color
-            num_labels, labels = cv2.connectedComponents(mask)
-            
-            for i in range(1, num_labels):
-                component_mask = (labels == i)
-                component_area = np.sum(component_mask)
-                
-                if component_area >= min_area:
-                    regions[component_mask] = region_id
-                    logger.info(f"Created region {region_id} with area {component_area} for color {color}")
-                    region_id += 1
+        def label_color(index: int) -> Tuple[np.ndarray, np.ndarray]:
+            # Create mask for this color and find its connected components
+            mask = (color_index == index).astype(np.uint8)
+            _, labels, stats, _ = cv2.connectedComponentsWithStats(mask)
+            return labels, stats[:, cv2.CC_STAT_AREA]
+        
+        # Colors are labeled in parallel, one batch per pool thread at a time so
+        # only that many label maps are alive; region ids are then assigned in
+        # color order so the result does not depend on the thread count
+        indices = list(range(len(unique_colors)))
+        for start in range(0, len(indices), self._pool_threads):
+            batch = indices[start:start + self._pool_threads]
+            for index, (labels, areas) in zip(batch, self._map(label_color, batch)):
+                lookup = np.zeros(len(areas), dtype=np.int32)
+                for i in range(1, len(areas)):
+                    if areas[i] >= min_area:
+                        lookup[i] = region_id
+                        logger.info(f"Created region {region_id} with area {areas[i]} for color {unique_colors[index]}")
+                        region_id += 1
+                # Background (label 0) maps to 0, so colors never overwrite each other
+                regions += lookup[labels]
         
         logger.info(f"Created {region_id - 1} color-based regions")
         return regions
     def find_optimal_label_position(self, region_mask: np.ndarray, existing_positions: List[Tuple[int, int]], min_distance: int = 30) -> Tuple[int, int]:
         """Find the optimal position for label placement using regionprops."""
+        # Imported lazily: scikit-image is slow to import and only needed here
+        from skimage.measure import regionprops
+
         # Get region properties
         regions = regionprops(region_mask.astype(int))
         
@@ -342,25 +877,143 @@ class PaintByNumbersProcessor:
             
         return best_position
     
-    def place_label(self, img: np.ndarray, text: str, position: Tuple[int, int], 
-                   font_scale: float = 1.0, thickness: int = 1,
-                   padding: int = 4, bg_color: Tuple[int, int, int] = (255,255,255), 
-                   text_color: Tuple[int, int, int] = (255,255,255)) -> None:
-        """Place a simple white text label without background box."""
-        cx, cy = position
-        font = cv2.FONT_HERSHEY_SIMPLEX
-        
-        # Get text size for centering
-        (text_w, text_h), baseline = cv2.getTextSize(text, font, font_scale, thickness)
-        
-        # Calculate centered position
-        text_pos = (cx - text_w//2, cy + text_h//2)
-        
-        # Draw simple white text with black outline for visibility
-        cv2.putText(img, text, text_pos, font, font_scale, (0,0,0), thickness+1, cv2.LINE_AA)  # Black outline
-        cv2.putText(img, text, text_pos, font, font_scale, text_color, thickness, cv2.LINE_AA)  # White text
+    def color_index_map(self, reduced_image: np.ndarray, color_palette: List[Tuple[int, int, int]]) -> np.ndarray:
+        """
+        Palette index of every pixel of a color-reduced image.
+        
+        Every pixel of the reduced image is a palette color; when two palette
+        entries round to the same color the first one wins.
+        """
+        def pack(colors: np.ndarray) -> np.ndarray:
+            colors = colors.astype(np.uint32)
+            return (colors[..., 0] << 16) | (colors[..., 1] << 8) | colors[..., 2]
+        
+        packed_palette = pack(np.asarray(color_palette, dtype=np.uint8).reshape(-1, 3))
+        order = np.argsort(packed_palette, kind='stable')
+        positions = np.searchsorted(packed_palette[order], pack(reduced_image))
+        return order[np.minimum(positions, len(order) - 1)].astype(np.uint16)
+    
+    def compute_region_stats(self, regions: np.ndarray, color_map: Optional[np.ndarray], num_colors: int) -> np.ndarray:
+        """
+        Build the region stats table: color, area, bounding box and label placement.
+        
+        Args:
+            regions: Region labels array
+            color_map: Palette index of every pixel (see color_index_map), or
+                None to number regions in palette order
+            num_colors: Palette size
+            
+        Returns:
+            REGION_STATS_DTYPE array with one row per region
+        """
+        from scipy.ndimage import find_objects
+        
+        height, width = regions.shape
+        max_region = int(regions.max())
+        bounding_boxes = find_objects(regions, max_label=max_region)
+        areas = np.bincount(regions.ravel(), minlength=max_region + 1)
+        
+        # Track existing label positions to avoid overlaps
+        existing_positions = []
+        rows = []
+        
+        # Place numbers with optimal positioning
+        for region_id in range(1, max_region + 1):
+            box = bounding_boxes[region_id - 1]
+            if box is None:
+                continue
+            mask = (regions == region_id)
+            
+            # Color number of the region (0-based palette index)
+            if color_map is not None:
+                color_index = int(color_map[box][regions[box] == region_id][0])
+            else:
+                color_index = (region_id - 1) % num_colors
+            
+            # Find optimal position for this label
+            optimal_pos = self.find_optimal_label_position(mask, existing_positions, min_distance=60)
+            
+            # Make sure position is within image bounds
+            optimal_pos = (
+                max(30, min(optimal_pos[0], width - 30)),
+                max(30, min(optimal_pos[1], height - 30))
+            )
+            
+            # Calculate font scale based on region size - even smaller; snapped to
+            # the glyph atlas grid so the stored scale is the one drawn
+            region_area = int(areas[region_id])
+            font_scale = quantize_scale(max(0.3, min(0.5, np.sqrt(region_area) / 300)))
+            
+            # Track this position
+            existing_positions.append(optimal_pos)
+            rows.append((region_id, color_index, region_area, box[1].start, box[0].start, box[1].stop, box[0].stop,
+                         optimal_pos[0], optimal_pos[1], font_scale))
+            
+            logger.info(f"Placed number {color_index + 1} for region {region_id} at optimal position ({optimal_pos[0]}, {optimal_pos[1]})")
+        
+        return np.array(rows, dtype=REGION_STATS_DTYPE)
+    
+    def _highlight(self, image: np.ndarray, mask: np.ndarray) -> None:
+        """Wash out everything outside mask towards white, in place."""
+        outside = ~mask
+        image[outside] = (image[outside].astype(np.uint16) + 2 * 255) // 3
+    
+    def render_template(self, background: np.ndarray, regions: np.ndarray, region_stats: np.ndarray,
+                        style: Optional[Dict[str, Any]] = None, color_map: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Draw region boundaries and number labels over a background image.
+        
+        Args:
+            background: Image to draw on (the color-reduced image, or white)
+            regions: Region labels array
+            region_stats: Region stats table from compute_region_stats
+            style: Optional 'line_width' (boundary thickness, 0 for none),
+                'label_scale' (multiplier on label size) and 'highlight_color'
+                (1-based palette number to emphasise; needs color_map)
+            color_map: Palette index of every pixel, used for highlighting
+            
+        Returns:
+            Rendered template image
+        """
+        style = style or {}
+        line_width = int(style.get('line_width', 1))
+        label_scale = float(style.get('label_scale', 1.0))
+        highlight = style.get('highlight_color')
+        
+        template = background.copy()
+        if highlight is not None and color_map is not None:
+            self._highlight(template, color_map == int(highlight) - 1)
+        
+        # Draw subtle region boundaries for better definition. Contours are
+        # traced per region on its bounding box, in parallel batches; drawing
+        # stays sequential and in region order so anti-aliased overlaps match
+        def trace(rows: np.ndarray) -> List[list]:
+            traced = []
+            for row in rows:
+                box = (slice(row['y0'], row['y1']), slice(row['x0'], row['x1']))
+                # Pad by one pixel so regions touching the box edge trace like in the full image
+                mask = np.pad((regions[box] == row['region']).astype(np.uint8), 1)
+                contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE,
+                                               offset=(int(row['x0']) - 1, int(row['y0']) - 1))
+                traced.append(contours)
+            return traced
+        
+        if line_width > 0:
+            for batch in self._map(trace, self._chunks(region_stats)):
+                for contours in batch:
+                    if contours:
+                        # Draw thin dark lines for region boundaries
+                        cv2.drawContours(template, contours, -1, (0, 0, 0), line_width, cv2.LINE_AA)
+        
+        # White text with black outline for visibility, all labels blitted in one batch
+        labels = [(str(int(row['color']) + 1), (int(row['label_x']), int(row['label_y'])),
+                   float(row['font_scale']) * label_scale) for row in region_stats]
+        atlas.draw(template, labels, thickness=1, outline=2)
+        return template
     
-    def generate_template(self, regions: np.ndarray, color_palette: List[Tuple[int, int, int]], settings: Dict[str, Any], reduced_image: np.ndarray = None) -> Optional[str]:
+    def generate_template(self, regions: np.ndarray, color_palette: List[Tuple[int, int, int]], settings: Dict[str, Any],
+                          reduced_image: np.ndarray = None, output_dir: Optional[str] = None,
+                          region_stats: Optional[np.ndarray] = None) -> Optional[str]:
         """
         Generate numbered template image with colored background and optimal label placement.
         
@@ -369,17 +1022,13 @@ class PaintByNumbersProcessor:
             color_palette: Color palette
             settings: Processing settings
             reduced_image: The color-reduced image to use as background
+            output_dir: Directory to write to (defaults to the processor temp dir)
+            region_stats: Precomputed region stats table (computed here if omitted)
             
         Returns:
             Path to generated template file
         """
         try:
-            # Create template image with colored background
-            if reduced_image is not None:
-                template = reduced_image.copy()
-            else:
-                template = np.ones((regions.shape[0], regions.shape[1], 3), dtype=np.uint8) * 255
-            
             max_region = regions.max()
             logger.info(f"Generating template with {max_region} regions using optimal placement")
             
@@ -387,59 +1036,22 @@ class PaintByNumbersProcessor:
                 logger.warning("No regions found!")
                 return None
             
-            height, width = regions.shape
-            
-            # Draw subtle region boundaries for better definition
-            for region_id in range(1, max_region + 1):
-                mask = (regions == region_id).astype(np.uint8)
-                if np.any(mask):
-                    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-                    # Draw thin dark lines for region boundaries
-                    cv2.drawContours(template, contours, -1, (0, 0, 0), 1, cv2.LINE_AA)
-            
-            # Track existing label positions to avoid overlaps
-            existing_positions = []
-            numbers_placed = 0
+            # Create template image with colored background
+            if reduced_image is not None:
+                background = reduced_image
+            else:
+                background = np.ones((regions.shape[0], regions.shape[1], 3), dtype=np.uint8) * 255
             
-            # Place numbers with optimal positioning
-            for region_id in range(1, max_region + 1):
-                mask = (regions == region_id)
-                
-                if not np.any(mask):
-                    continue
-                
-                # Calculate color number
-                color_num = ((region_id - 1) % len(color_palette)) + 1
-                text = str(color_num)
-                
-                # Find optimal position for this label
-                optimal_pos = self.find_optimal_label_position(mask, existing_positions, min_distance=60)
-                
-                # Make sure position is within image bounds
-                optimal_pos = (
-                    max(30, min(optimal_pos[0], width - 30)),
-                    max(30, min(optimal_pos[1], height - 30))
-                )
-                
-                # Calculate font scale based on region size - even smaller
-                region_area = np.sum(mask)
-                font_scale = max(0.3, min(0.5, np.sqrt(region_area) / 300))
-                
-                # Place the simple white text label
-                self.place_label(template, text, optimal_pos, 
-                               font_scale=font_scale, thickness=1)
-                
-                # Track this position
-                existing_positions.append(optimal_pos)
-                numbers_placed += 1
-                
-                logger.info(f"Placed number {color_num} for region {region_id} at optimal position ({optimal_pos[0]}, {optimal_pos[1]})")
+            if region_stats is None:
+                color_map = self.color_index_map(reduced_image, color_palette) if reduced_image is not None else None
+                region_stats = self.compute_region_stats(regions, color_map, len(color_palette))
+            template = self.render_template(background, regions, region_stats)
             
             # Save template
-            template_path = os.path.join(self.temp_dir, 'template.png')
-            cv2.imwrite(template_path, cv2.cvtColor(template, cv2.COLOR_RGB2BGR))
+            template_path = os.path.join(output_dir or self.temp_dir, 'template.png')
+            self._write_image(template_path, template, settings)
             
-            logger.info(f"Template generated with {numbers_placed} optimally placed numbers")
+            logger.info(f"Template generated with {len(region_stats)} optimally placed numbers")
             return template_path
             
         except Exception as e:
@@ -448,13 +1060,18 @@ class PaintByNumbersProcessor:
             logger.error(f"Traceback: {traceback.format_exc()}")
             return None
     
-    def generate_color_reference(self, color_palette: List[Tuple[int, int, int]], settings: Dict[str, Any]) -> Optional[str]:
+    def generate_color_reference(self, color_palette: List[Tuple[int, int, int]], settings: Dict[str, Any], output_dir: Optional[str] = None,
+                                 style: Optional[Dict[str, Any]] = None,
+                                 paints: Optional[List[Dict[str, Any]]] = None) -> Optional[str]:
         """
         Generate color reference chart.
         
         Args:
             color_palette: Color palette
             settings: Processing settings
+            output_dir: Directory to write to (defaults to the processor temp dir)
+            style: Optional 'highlight_color' (1-based palette number to frame)
+            paints: Catalog paint for each palette color, printed instead of RGB values
             
         Returns:
             Path to generated reference file
@@ -466,10 +1083,14 @@ class PaintByNumbersProcessor:
             cols = min(5, len(color_palette))
             rows = (len(color_palette) + cols - 1) // cols
             
+            # Paint names need up to two lines under each swatch
+            paint_space = 24 if paints else 0
+            
             ref_width = cols * swatch_size + (cols + 1) * margin
-            ref_height = rows * swatch_size + (rows + 1) * margin + 80  # Extra space for title
+            ref_height = rows * (swatch_size + paint_space) + (rows + 1) * margin + 80  # Extra space for title
             
             reference = np.ones((ref_height, ref_width, 3), dtype=np.uint8) * 255
+            highlight = (style or {}).get('highlight_color')
             
             # Add title
             title = 'Paint-by-Numbers Color Reference'
@@ -482,16 +1103,19 @@ class PaintByNumbersProcessor:
                        cv2.FONT_HERSHEY_SIMPLEX, title_font_scale, (0, 0, 0), title_thickness)
             
             # Draw color swatches
+            number_labels = []
             for i, color in enumerate(color_palette):
                 row = i // cols
                 col = i % cols
                 
                 x = margin + col * (swatch_size + margin)
-                y = 80 + margin + row * (swatch_size + margin)
+                y = 80 + margin + row * (swatch_size + paint_space + margin)
                 
                 # Draw color swatch
                 cv2.rectangle(reference, (x, y), (x + swatch_size, y + swatch_size), color, -1)
                 cv2.rectangle(reference, (x, y), (x + swatch_size, y + swatch_size), (0, 0, 0), 3)
+                if highlight == i + 1:
+                    cv2.rectangle(reference, (x - 8, y - 8), (x + swatch_size + 8, y + swatch_size + 8), (255, 0, 0), 4)
                 
                 # Add number label with better visibility
                 number_text = str(i + 1)
@@ -504,29 +1128,43 @@ class PaintByNumbersProcessor:
                 
                 # Add white background circle for number
                 circle_radius = max(text_size) // 2 + 8
-                cv2.circle(reference, (text_x + text_size[0]//2, text_y - text_size[1]//2), 
-                          circle_radius, (255, 255, 255), -1)
-                cv2.circle(reference, (text_x + text_size[0]//2, text_y - text_size[1]//2), 
-                          circle_radius, (0, 0, 0), 2)
+                circle_center = (text_x + text_size[0]//2, text_y - text_size[1]//2)
+                cv2.circle(reference, circle_center, circle_radius, (255, 255, 255), -1)
+                cv2.circle(reference, circle_center, circle_radius, (0, 0, 0), 2)
                 
-                # Add number text
-                cv2.putText(reference, number_text, (text_x, text_y), 
-                           cv2.FONT_HERSHEY_SIMPLEX, font_scale, (0, 0, 0), thickness)
+                # Queue number text, centred in the circle
+                number_labels.append((number_text, circle_center, font_scale))
                 
-                # Add color RGB values
-                rgb_text = f"RGB({color[0]},{color[1]},{color[2]})"
                 small_font_scale = 0.4
                 small_thickness = 1
-                rgb_size = cv2.getTextSize(rgb_text, cv2.FONT_HERSHEY_SIMPLEX, small_font_scale, small_thickness)[0]
-                rgb_x = x + (swatch_size - rgb_size[0]) // 2
-                rgb_y = y + swatch_size + 20
-                
-                cv2.putText(reference, rgb_text, (rgb_x, rgb_y), 
-                           cv2.FONT_HERSHEY_SIMPLEX, small_font_scale, (100, 100, 100), small_thickness)
+                if paints:
+                    # Paint name, one mix component per line, shrunk to the column width
+                    for line_number, line in enumerate(paints[i]['name'].split(' + ')):
+                        line_scale = small_font_scale
+                        line_size = cv2.getTextSize(line, cv2.FONT_HERSHEY_SIMPLEX, line_scale, small_thickness)[0]
+                        if line_size[0] > swatch_size + margin - 4:
+                            line_scale *= (swatch_size + margin - 4) / line_size[0]
+                            line_size = cv2.getTextSize(line, cv2.FONT_HERSHEY_SIMPLEX, line_scale, small_thickness)[0]
+                        line_x = x + (swatch_size - line_size[0]) // 2
+                        line_y = y + swatch_size + 20 + line_number * 16
+                        cv2.putText(reference, line, (line_x, line_y),
+                                   cv2.FONT_HERSHEY_SIMPLEX, line_scale, (60, 60, 60), small_thickness, cv2.LINE_AA)
+                else:
+                    # Add color RGB values
+                    rgb_text = f"RGB({color[0]},{color[1]},{color[2]})"
+                    rgb_size = cv2.getTextSize(rgb_text, cv2.FONT_HERSHEY_SIMPLEX, small_font_scale, small_thickness)[0]
+                    rgb_x = x + (swatch_size - rgb_size[0]) // 2
+                    rgb_y = y + swatch_size + 20
+                    
+                    cv2.putText(reference, rgb_text, (rgb_x, rgb_y), 
+                               cv2.FONT_HERSHEY_SIMPLEX, small_font_scale, (100, 100, 100), small_thickness)
+            
+            # Add all swatch numbers in one batch from the glyph atlas
+            atlas.draw(reference, number_labels, thickness=3, text_color=(0, 0, 0))
             
             # Save reference
-            reference_path = os.path.join(self.temp_dir, 'reference.png')
-            cv2.imwrite(reference_path, cv2.cvtColor(reference, cv2.COLOR_RGB2BGR))
+            reference_path = os.path.join(output_dir or self.temp_dir, 'reference.png')
+            self._write_image(reference_path, reference, settings)
             
             logger.info(f"Color reference generated with {len(color_palette)} colors")
             return reference_path
@@ -537,13 +1175,17 @@ class PaintByNumbersProcessor:
             logger.error(f"Traceback: {traceback.format_exc()}")
             return None
     
-    def generate_solution(self, reduced_image: np.ndarray, settings: Dict[str, Any]) -> Optional[str]:
+    def generate_solution(self, reduced_image: np.ndarray, settings: Dict[str, Any], output_dir: Optional[str] = None,
+                          style: Optional[Dict[str, Any]] = None, color_map: Optional[np.ndarray] = None) -> Optional[str]:
         """
         Generate solution image (colored version).
         
         Args:
             reduced_image: Color-reduced image
             settings: Processing settings
+            output_dir: Directory to write to (defaults to the processor temp dir)
+            style: Optional 'highlight_color' (1-based palette number to emphasise; needs color_map)
+            color_map: Palette index of every pixel, used for highlighting
             
         Returns:
             Path to generated solution file
@@ -551,12 +1193,15 @@ class PaintByNumbersProcessor:
         try:
             # Create a clean copy of the reduced image to ensure no contamination
             clean_solution = reduced_image.copy()
+            highlight = (style or {}).get('highlight_color')
+            if highlight is not None and color_map is not None:
+                self._highlight(clean_solution, color_map == int(highlight) - 1)
             
             logger.info(f"Generating solution with clean reduced image. Shape: {clean_solution.shape}")
             
             # Save solution
-            solution_path = os.path.join(self.temp_dir, 'solution.png')
-            cv2.imwrite(solution_path, cv2.cvtColor(clean_solution, cv2.COLOR_RGB2BGR))
+            solution_path = os.path.join(output_dir or self.temp_dir, 'solution.png')
+            self._write_image(solution_path, clean_solution, settings)
             
             logger.info("Solution generated successfully - should be clean colored image without numbers")
             return solution_path
@@ -0,0 +1,328 @@
+import json
+import os
+import re
+import threading
+from dataclasses import dataclass, asdict, field, replace
+from typing import Any, Dict, List, Optional, Tuple
+import logging
+
+import numpy as np
+
+from paint_processor import KMEANS_ATTEMPTS, KMEANS_ITERATIONS, kmeans_sample_size
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on regions per palette color used to predict template cost
+REGIONS_PER_COLOR = 8
+# Plan to this fraction of the budget to leave room for model error
+BUDGET_SAFETY = 0.8
+# Resolution scales tried below the cheapest tier when a budget is still missed
+FALLBACK_RESOLUTION_SCALES = (0.5, 0.4, 0.3)
+# Weight of each new observation when recalibrating coefficients online
+EWMA_ALPHA = 0.2
+
+# Seconds per unit of each stage feature term (see stage_features), fitted
+# with `python -m benchmarks.pipeline --save-cost-model` on a 1-vCPU instance
+DEFAULT_COEFFICIENTS = {
+    'load': [1.2e-08],
+    'resize': [1.4e-08],
+    'blur': [2.0e-09],
+    'reduce_colors': [1.0e-08, 2.5e-08, 1.3e-07],
+    'create_regions': [1.06e-06, 6.2e-09],
+    'generate_template': [1.25e-06, 0.0],
+    'generate_color_reference': [0.0, 6.3e-04],
+    'generate_solution': [1.6e-08],
+    'write_outputs': [1.0e-08],
+}
+
+
+@dataclass
+class QualityTier:
+    """Knob settings for one quality level."""
+    name: str
+    resolution_scale: float      # applied to the admitted processing size
+    kmeans_sample_scale: float   # applied to the k-means sample size
+    kmeans_iterations: int
+    kmeans_attempts: int
+    min_area_scale: float        # larger merges more small regions away
+    png_compression: Optional[int]  # None keeps the OpenCV default
+
+
+# Ordered from best to cheapest; 'high' is the untiered pipeline, so a tier
+# can only turn knobs down. The frontend sends 'high' (desktop) or 'low' (mobile)
+TIERS = [
+    QualityTier('high', 1.0, 1.0, KMEANS_ITERATIONS, KMEANS_ATTEMPTS, 1.0, None),
+    QualityTier('medium', 0.9, 0.8, KMEANS_ITERATIONS, 1, 1.25, 1),
+    QualityTier('low', 0.8, 0.6, 2, 1, 1.5, 1),
+    QualityTier('minimal', 0.6, 0.4, 2, 1, 2.5, 0),
+]
+TIER_NAMES = [tier.name for tier in TIERS]
+# Knobs only a QualityPlan may set; /api/process drops them from client settings
+TIER_ONLY_KNOBS = ('kmeans_sample_scale', 'kmeans_iterations', 'kmeans_attempts', 'png_compression')
+
+
+@dataclass
+class QualityPlan:
+    """The knobs chosen for a job and how they compare with the budget."""
+    tier: str
+    time_budget_seconds: Optional[float]
+    predicted_seconds: float
+    knobs: Dict[str, Any]
+    reduced_knobs: List[str] = field(default_factory=list)
+    actual_seconds: Optional[float] = None
+
+    def to_dict(self):
+        return asdict(self)
+
+
+def stage_features(decoded_px: int, work_px: int, num_colors: int, min_area: int, sample_size: int,
+                   iterations: int, attempts: int) -> Dict[str, List[float]]:
+    """
+    Work terms per stage; predicted stage time is the dot product of these
+    with the stage's coefficients.
+    """
+    # Region count depends on content; bound it by what min_area allows
+    regions = min(work_px / max(min_area, 1), REGIONS_PER_COLOR * num_colors)
+    return {
+        'load': [decoded_px],
+        'resize': [decoded_px],
+        'blur': [work_px],
+        'reduce_colors': [sample_size * iterations * attempts * num_colors, work_px * num_colors, work_px],
+        'create_regions': [work_px, work_px * num_colors],
+        'generate_template': [work_px, work_px * regions],
+        'generate_color_reference': [1, num_colors],
+        'generate_solution': [work_px],
+        'write_outputs': [work_px],
+    }
+
+
+# Stages that run once per palette variant in multi-variant mode
+PER_VARIANT_STAGES = ('create_regions', 'generate_template', 'generate_color_reference',
+                      'generate_solution', 'write_outputs')
+# Per-variant stage timings are recorded as '<stage>_k<palette size>'
+VARIANT_STAGE_RE = re.compile(r'^(?P<stage>.+)_k\d+$')
+
+
+def fold_variant_timings(stage_timings: Dict[str, float]) -> Dict[str, float]:
+    """
+    Average per-variant timings ('create_regions_k10', ...) into their base
+    stage, so they compare with the single-run prediction for that stage.
+    """
+    runs: Dict[str, List[float]] = {}
+    for stage, seconds in stage_timings.items():
+        match = VARIANT_STAGE_RE.match(stage)
+        runs.setdefault(match.group('stage') if match else stage, []).append(seconds)
+    return {stage: sum(values) / len(values) for stage, values in runs.items()}
+
+
+class CostModel:
+    """
+    Linear per-stage cost model.
+
+    Coefficients start from a calibration file (COST_MODEL_PATH, written by
+    the pipeline benchmark) or DEFAULT_COEFFICIENTS, and each stage's are
+    scaled online towards the timings every processed job records.
+    """
+
+    def __init__(self, coefficients: Optional[Dict[str, List[float]]] = None):
+        self.coefficients = {stage: list(values) for stage, values in DEFAULT_COEFFICIENTS.items()}
+        for stage, values in (coefficients or {}).items():
+            if len(values) == len(self.coefficients.get(stage, values)):
+                self.coefficients[stage] = list(values)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> 'CostModel':
+        """Load coefficients from COST_MODEL_PATH (default backend/cost_model.json) if present."""
+        path = os.getenv('COST_MODEL_PATH') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cost_model.json')
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    return cls(json.load(f))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring cost model {path}: {str(e)}")
+        return cls()
+
+    @staticmethod
+    def fit(records: List[Tuple[Dict[str, List[float]], Dict[str, float]]]) -> Dict[str, List[float]]:
+        """
+        Fit non-negative coefficients per stage by least squares.
+
+        Args:
+            records: (stage_features, stage_timings) for each benchmarked job
+
+        Returns:
+            Coefficients for every stage that appeared in the timings
+        """
+        from scipy.optimize import nnls
+
+        coefficients = {}
+        for stage in DEFAULT_COEFFICIENTS:
+            rows = [(features[stage], timings[stage]) for features, timings in records if stage in timings]
+            if not rows:
+                continue
+            terms = np.array([row for row, _ in rows], dtype=np.float64)
+            seconds = np.array([t for _, t in rows], dtype=np.float64)
+            # Scale columns so tiny and huge terms are solved with equal precision
+            scale = np.abs(terms).max(axis=0)
+            scale[scale == 0] = 1.0
+            solution, _ = nnls(terms / scale, seconds)
+            coefficients[stage] = [float(c) for c in solution / scale]
+        return coefficients
+
+    def predict_stage(self, stage: str, terms: List[float]) -> float:
+        return sum(c * t for c, t in zip(self.coefficients.get(stage, []), terms))
+
+    def predict(self, features: Dict[str, List[float]], variants: int = 1) -> float:
+        """Predicted seconds for a job; render stages repeat once per variant."""
+        total = 0.0
+        for stage, terms in features.items():
+            seconds = self.predict_stage(stage, terms)
+            total += seconds * variants if stage in PER_VARIANT_STAGES else seconds
+        return total
+
+    def observe(self, features: Dict[str, List[float]], stage_timings: Dict[str, float]) -> None:
+        """
+        Scale each stage's coefficients towards one job's measured timings;
+        multi-variant timings are folded into their base stage first.
+        """
+        with self._lock:
+            for stage, seconds in fold_variant_timings(stage_timings).items():
+                if stage not in features:
+                    continue
+                predicted = self.predict_stage(stage, features[stage])
+                if predicted <= 0:
+                    continue
+                # Bound single outliers (e.g. a very busy photo) to a 2x swing
+                ratio = min(max(seconds / predicted, 0.5), 2.0)
+                factor = 1 + EWMA_ALPHA * (ratio - 1)
+                self.coefficients[stage] = [c * factor for c in self.coefficients[stage]]
+
+
+def parse_time_budget(settings: Dict[str, Any]) -> Optional[float]:
+    """
+    Read settings['time_budget_seconds'].
+
+    Raises:
+        ValueError: if the budget is not a positive number
+    """
+    budget = settings.get('time_budget_seconds')
+    if budget is None:
+        return None
+    try:
+        budget = float(budget)
+    except (TypeError, ValueError):
+        raise ValueError('time_budget_seconds must be a number')
+    if budget <= 0:
+        raise ValueError('time_budget_seconds must be positive')
+    return budget
+
+
+def requested_tier(settings: Dict[str, Any]) -> Optional[str]:
+    """
+    Tier named by settings['quality'] or the frontend's settings['optimization']['quality'].
+
+    Raises:
+        ValueError: if optimization is not an object
+    """
+    optimization = settings.get('optimization') or {}
+    if not isinstance(optimization, dict):
+        raise ValueError('optimization must be an object')
+    name = settings.get('quality') or optimization.get('quality')
+    return name if name in TIER_NAMES else None
+
+
+def _evaluate_tier(model: CostModel, tier: QualityTier, decoded_size: Tuple[int, int], work_size: Tuple[int, int],
+                   settings: Dict[str, Any], variants: int, num_colors: Optional[int]) -> Tuple[float, Dict[str, Any]]:
+    """Predicted seconds and knob settings for running a job at one tier."""
+    size = (max(1, int(work_size[0] * tier.resolution_scale)), max(1, int(work_size[1] * tier.resolution_scale)))
+    work_px = size[0] * size[1]
+    min_area = int(settings.get('min_area', 50) * tier.min_area_scale)
+    sample = kmeans_sample_size(work_px, settings.get('mobile_optimized', False), tier.kmeans_sample_scale)
+    features = stage_features(decoded_size[0] * decoded_size[1], work_px, num_colors or settings.get('num_colors', 15),
+                              min_area, sample, tier.kmeans_iterations, tier.kmeans_attempts)
+    knobs = {
+        'max_image_size': list(size),
+        'kmeans_sample_scale': tier.kmeans_sample_scale,
+        'kmeans_iterations': tier.kmeans_iterations,
+        'kmeans_attempts': tier.kmeans_attempts,
+        'min_area': min_area,
+        'png_compression': tier.png_compression,
+    }
+    return model.predict(features, variants), knobs
+
+
+def predict_seconds(model: CostModel, decoded_size: Tuple[int, int], work_size: Tuple[int, int],
+                    settings: Dict[str, Any], variants: int = 1, num_colors: Optional[int] = None) -> float:
+    """Predicted processing time of a job run untiered (the slowest tier) at work_size."""
+    predicted, _ = _evaluate_tier(model, TIERS[0], decoded_size, work_size, settings, variants, num_colors)
+    return predicted
+
+
+def plan_quality(model: CostModel, decoded_size: Tuple[int, int], work_size: Tuple[int, int],
+                 settings: Dict[str, Any], variants: int = 1, num_colors: Optional[int] = None,
+                 spent_seconds: float = 0.0, min_size: Tuple[int, int] = (320, 240)) -> Optional[QualityPlan]:
+    """
+    Choose quality knobs for a job.
+
+    With a time budget the best tier predicted to finish within it is chosen;
+    a named tier is used as is, or as the best tier allowed when a budget is
+    also given. If even the cheapest tier misses the budget its resolution is
+    lowered further, down to min_size. Returns None when neither is set,
+    leaving the pipeline untouched.
+    
+    Args:
+        model: Cost model used to predict processing time
+        decoded_size: (width, height) of the upload
+        work_size: (width, height) the image would be processed at by admission
+        settings: Processing settings
+        variants: Number of palette variants rendered
+        num_colors: Palette size clustered (the largest variant in multi-variant
+            mode); defaults to settings['num_colors']
+        spent_seconds: Time already spent on the request (e.g. queued for admission)
+        min_size: Smallest processing size a budget may push the image down to
+    """
+    budget = parse_time_budget(settings)
+    requested = requested_tier(settings)
+    if requested is None and budget is None:
+        return None
+    available = None if budget is None else max(budget - spent_seconds, 0.0)
+
+    candidates = TIERS[TIER_NAMES.index(requested):] if requested else list(TIERS)
+    if available is not None:
+        floor_area = min_size[0] * min_size[1]
+        for scale in FALLBACK_RESOLUTION_SCALES:
+            if work_size[0] * work_size[1] * scale * scale < floor_area:
+                break
+            candidates.append(replace(TIERS[-1], resolution_scale=scale))
+
+    def evaluate(tier: QualityTier) -> Tuple[float, Dict[str, Any]]:
+        return _evaluate_tier(model, tier, decoded_size, work_size, settings, variants, num_colors)
+
+    chosen = candidates[-1]
+    predicted, knobs = evaluate(chosen)
+    for tier in candidates:
+        tier_predicted, tier_knobs = evaluate(tier)
+        if available is None or tier_predicted <= available * BUDGET_SAFETY:
+            chosen, predicted, knobs = tier, tier_predicted, tier_knobs
+            break
+
+    # Report every knob turned down relative to the untiered pipeline
+    _, best_knobs = evaluate(TIERS[0])
+    reduced = [name for name in knobs if knobs[name] != best_knobs[name]]
+
+    logger.info(f"Quality tier {chosen.name}: predicted {predicted:.2f}s, budget {budget}, reduced {reduced}")
+    return QualityPlan(chosen.name, budget, round(predicted, 2), knobs, reduced)
+
+
+def job_features(decoded_size: Tuple[int, int], settings: Dict[str, Any], work_size: Tuple[int, int],
+                 num_colors: Optional[int] = None) -> Dict[str, List[float]]:
+    """
+    Features of a finished job, for recalibrating the cost model; num_colors
+    is the palette size clustered (default settings['num_colors']).
+    """
+    work_px = work_size[0] * work_size[1]
+    return stage_features(
+        decoded_size[0] * decoded_size[1], work_px, num_colors or settings.get('num_colors', 15), settings.get('min_area', 50),
+        kmeans_sample_size(work_px, settings.get('mobile_optimized', False), settings.get('kmeans_sample_scale', 1.0)),
+        settings.get('kmeans_iterations', KMEANS_ITERATIONS), settings.get('kmeans_attempts', KMEANS_ATTEMPTS))
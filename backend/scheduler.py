@@ -0,0 +1,363 @@
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from typing import Iterator, Optional, Tuple
+import logging
+
+import psutil
+
+from paint_processor import PIXELS_PER_THREAD
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# Peak working memory of the pipeline per processed pixel, measured with
+# benchmarks (decode copies, float32 clustering data, labels, region map,
+# per-region masks and the rendered outputs). Roughly flat from 0.3 to 4 MP.
+BYTES_PER_PIXEL = 80
+# Extra bytes per pixel kept alive in multi-variant mode (shared labels plus
+# one reduced image per variant being rendered)
+VARIANT_BYTES_PER_PIXEL = 11
+# Extra bytes per pixel for each additional processor thread (per-color label
+# maps and per-region masks alive at the same time)
+THREAD_BYTES_PER_PIXEL = 14
+# Fixed per-job overhead (k-means buffers, label atlas blits, PNG encoders)
+BASE_OVERHEAD_MB = 10.0
+# Headroom on top of the estimate for allocator fragmentation
+SAFETY_FACTOR = 1.2
+
+# Processing-size ladder tried, largest first, when memory is short
+DEGRADE_SCALES = (1.0, 0.85, 0.7, 0.55, 0.4, 0.3)
+
+# How much later than a reservation its worker may appear to have started
+PID_START_SLACK_SECONDS = 2.0
+
+
+class AdmissionError(Exception):
+    """Raised when a job could not be admitted before the queue timeout."""
+
+
+@dataclass
+class JobPlan:
+    """How a job was admitted: processing size, memory estimate and decision."""
+    max_image_size: Tuple[int, int]
+    estimated_mb: float
+    budget_mb: float
+    decision: str  # 'admitted', 'degraded' or 'forced'
+    queued_seconds: float = 0.0
+
+    def to_dict(self):
+        return asdict(self)
+
+
+def image_dimensions(path: str) -> Optional[Tuple[int, int]]:
+    """Read (width, height) from the image header without decoding pixels."""
+    try:
+        from PIL import Image
+        with Image.open(path) as img:
+            return img.size
+    except Exception as e:
+        logger.warning(f"Could not read dimensions of {path}: {str(e)}")
+        return None
+
+
+def _read_int(path: str) -> Optional[int]:
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+        return None if value == 'max' else int(value)
+    except (OSError, ValueError):
+        return None
+
+
+def available_memory_mb() -> float:
+    """
+    Live memory budget: system available memory, capped by the container's
+    cgroup limit when one is set (Render/Railway/Docker enforce these).
+    """
+    available = psutil.virtual_memory().available
+    for limit_file, usage_file in (
+        ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),  # cgroup v2
+        ('/sys/fs/cgroup/memory/memory.limit_in_bytes', '/sys/fs/cgroup/memory/memory.usage_in_bytes'),  # v1
+    ):
+        limit, usage = _read_int(limit_file), _read_int(usage_file)
+        # cgroup v1 reports "no limit" as a huge number
+        if limit and usage is not None and limit < (1 << 60):
+            available = min(available, limit - usage)
+            break
+    return max(0.0, available / MB)
+
+
+def estimate_peak_memory_mb(width: int, height: int, work_size: Tuple[int, int], num_colors: int,
+                            variants: int = 1, threads: int = 1) -> float:
+    """
+    Estimate a job's peak memory in MB.
+
+    Args:
+        width, height: Dimensions of the uploaded image (decoded at full size)
+        work_size: (width, height) the image is processed at after resizing
+        num_colors: Largest palette size requested
+        variants: Number of palette variants rendered from one clustering pass
+        threads: Processor thread budget (the processor uses fewer on small images)
+    """
+    decoded_px = width * height
+    work_px = work_size[0] * work_size[1]
+    # Decode holds a BGR and an RGB copy until the resize
+    total = decoded_px * 6 if decoded_px > work_px else 0
+    total += work_px * BYTES_PER_PIXEL
+    if variants > 1:
+        total += work_px * VARIANT_BYTES_PER_PIXEL * variants
+    threads = min(threads, max(1, work_px // PIXELS_PER_THREAD))
+    total += work_px * THREAD_BYTES_PER_PIXEL * (threads - 1)
+    # Chunked nearest-center assignment: 16k pixels x num_colors x float32 x 3, plus a temporary
+    total += 16384 * num_colors * 12 * 2
+    return round((total / MB + BASE_OVERHEAD_MB) * SAFETY_FACTOR, 1)
+
+
+def fitted_size(width: int, height: int, max_size: Tuple[int, int]) -> Tuple[int, int]:
+    """Dimensions after the processor's aspect-preserving resize to max_size."""
+    max_w, max_h = max_size
+    if width <= max_w and height <= max_h:
+        return width, height
+    scale = min(max_w / width, max_h / height)
+    return int(width * scale), int(height * scale)
+
+
+class SharedReservations:
+    """
+    Memory reserved by running jobs, shared by every worker process on the box.
+
+    gunicorn's sync workers run one request each, so per-process counters
+    never see the other workers' jobs. Reservations are rows in a small
+    SQLite database instead, read and written inside one exclusive
+    transaction per admission so two workers cannot both claim the same free
+    memory. Live free memory already excludes what running jobs have
+    allocated, so each row only counts the part of its estimate its worker
+    has not used yet (growth of the worker's RSS since admission). Rows left
+    by a worker that died mid-job, including rows whose PID now belongs to a
+    newer process, are dropped on the next read. The database is created on
+    first use.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS reservations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        pid INTEGER NOT NULL,
+        estimated_mb REAL NOT NULL,
+        created_at REAL NOT NULL,
+        rss_mb REAL NOT NULL DEFAULT 0
+    );
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._ready = False
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Exclusive write transaction; other workers' admissions wait for it."""
+        if not self._ready:
+            os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+            with sqlite3.connect(self.db_path, timeout=10) as conn:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.executescript(self.SCHEMA)
+                # Databases created before rss_mb was tracked
+                columns = [row[1] for row in conn.execute('PRAGMA table_info(reservations)')]
+                if 'rss_mb' not in columns:
+                    conn.execute('ALTER TABLE reservations ADD COLUMN rss_mb REAL NOT NULL DEFAULT 0')
+            self._ready = True
+
+        conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _outstanding_mb(pid: int, created_at: float, estimated_mb: float, rss_mb: float) -> Optional[float]:
+        """
+        Part of a row's estimate its worker has not allocated yet, or None if
+        that worker is gone. Containers reuse the same worker PIDs on every
+        restart, so a process with that PID that started after the row was
+        written is a different worker. psutil derives start times from the
+        whole-second boot time, hence the slack.
+        """
+        try:
+            process = psutil.Process(pid)
+            if process.create_time() > created_at + PID_START_SLACK_SECONDS:
+                return None
+            used_mb = process.memory_info().rss / MB - rss_mb
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            return None
+        return max(0.0, estimated_mb - used_mb)
+
+    @staticmethod
+    def totals(conn: sqlite3.Connection) -> Tuple[float, int]:
+        """
+        (MB reserved but not yet allocated, running jobs) across the box, after
+        dropping dead workers' rows.
+        """
+        live, stale = [], []
+        for row_id, pid, estimated_mb, created_at, rss_mb in conn.execute(
+                'SELECT id, pid, estimated_mb, created_at, rss_mb FROM reservations'):
+            outstanding = SharedReservations._outstanding_mb(pid, created_at, estimated_mb, rss_mb)
+            if outstanding is not None:
+                live.append(outstanding)
+            else:
+                stale.append((row_id,))
+        if stale:
+            conn.executemany('DELETE FROM reservations WHERE id = ?', stale)
+            logger.warning(f"Dropped {len(stale)} reservation(s) of exited workers")
+        return sum(live), len(live)
+
+    @staticmethod
+    def add(conn: sqlite3.Connection, estimated_mb: float) -> int:
+        rss_mb = psutil.Process().memory_info().rss / MB
+        cursor = conn.execute('INSERT INTO reservations (pid, estimated_mb, created_at, rss_mb) VALUES (?, ?, ?, ?)',
+                              (os.getpid(), estimated_mb, time.time(), rss_mb))
+        return cursor.lastrowid
+
+    def remove(self, reservation_id: int) -> None:
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM reservations WHERE id = ?', (reservation_id,))
+
+
+class MemoryScheduler:
+    """
+    Memory-aware admission control for processing jobs.
+
+    Before a job runs its peak memory is estimated from the upload's
+    dimensions, palette size and mode, and compared with the live memory
+    budget minus what jobs already admitted on this box (in any worker) have
+    reserved but not yet allocated. The job is admitted at the largest processing size that fits
+    (up to max_size), degraded down the DEGRADE_SCALES ladder if needed, or
+    queued until memory frees up. A job that fits nowhere while no other job
+    is running on the box runs at the smallest size rather than waiting
+    forever.
+    """
+
+    def __init__(self, db_path: str, max_size: Tuple[int, int] = (800, 600), min_size: Tuple[int, int] = (320, 240),
+                 mobile_max_size: Tuple[int, int] = (500, 375), reserve_mb: float = 64.0,
+                 queue_timeout: float = 20.0, poll_interval: float = 0.5):
+        self.max_size = max_size
+        self.min_size = min_size
+        self.mobile_max_size = mobile_max_size
+        self.reserve_mb = reserve_mb
+        self.queue_timeout = queue_timeout
+        self.poll_interval = poll_interval
+        self.reservations = SharedReservations(db_path)
+
+    @classmethod
+    def from_env(cls, db_path: str) -> 'MemoryScheduler':
+        """
+        Build a scheduler from MAX_PROCESSING_SIZE, MEMORY_RESERVE_MB and
+        ADMISSION_TIMEOUT, sharing reservations through db_path (or ADMISSION_DB_PATH).
+        """
+        def size(name: str, default: str) -> Tuple[int, int]:
+            w, h = os.getenv(name, default).lower().split('x')
+            return int(w), int(h)
+
+        return cls(
+            db_path=os.getenv('ADMISSION_DB_PATH') or db_path,
+            max_size=size('MAX_PROCESSING_SIZE', '800x600'),
+            min_size=size('MIN_PROCESSING_SIZE', '320x240'),
+            reserve_mb=float(os.getenv('MEMORY_RESERVE_MB', 64)),
+            queue_timeout=float(os.getenv('ADMISSION_TIMEOUT', 20)),
+        )
+
+    def size_cap(self, mobile: bool = False) -> Tuple[int, int]:
+        """Largest processing size a job may be admitted at."""
+        return self.mobile_max_size if mobile else self.max_size
+
+    def queue_timeout_for(self, remaining_seconds: float) -> float:
+        """
+        How long a job may wait for memory: queue_timeout, shortened so a job
+        that still needs remaining_seconds (time already spent on the request
+        plus predicted processing) finishes inside gunicorn's worker timeout.
+        A sync worker killed by the arbiter never gets to return the 503.
+        GUNICORN_WORKER_TIMEOUT is exported by gunicorn.conf.py; without it
+        (or with 0, gunicorn's "no timeout") queue_timeout applies as is.
+        """
+        worker_timeout = float(os.getenv('GUNICORN_WORKER_TIMEOUT') or 0)
+        if worker_timeout <= 0:
+            return self.queue_timeout
+        return max(0.0, min(self.queue_timeout, worker_timeout - remaining_seconds))
+
+    def budget_mb(self, reserved_mb: Optional[float] = None) -> float:
+        """Memory a new job may use right now."""
+        if reserved_mb is None:
+            with self.reservations.transaction() as conn:
+                reserved_mb, _ = self.reservations.totals(conn)
+        return round(available_memory_mb() - self.reserve_mb - reserved_mb, 1)
+
+    def plan(self, width: int, height: int, num_colors: int, variants: int = 1,
+             mobile: bool = False, threads: int = 1,
+             reserved_mb: Optional[float] = None) -> Tuple[Optional[JobPlan], JobPlan]:
+        """
+        Pick the largest processing size that fits the current budget.
+
+        Returns:
+            (plan that fits or None, smallest-size plan used as a last resort)
+        """
+        budget = self.budget_mb(reserved_mb)
+        full = fitted_size(width, height, self.size_cap(mobile))
+        floor_area = self.min_size[0] * self.min_size[1]
+
+        plan = None
+        for scale in DEGRADE_SCALES:
+            size = (max(1, int(full[0] * scale)), max(1, int(full[1] * scale)))
+            if scale < 1.0 and size[0] * size[1] < floor_area:
+                break
+            estimate = estimate_peak_memory_mb(width, height, size, num_colors, variants, threads)
+            plan = JobPlan(size, estimate, budget, 'admitted' if scale == 1.0 else 'degraded')
+            if estimate <= budget:
+                return plan, plan
+        return None, JobPlan(plan.max_image_size, plan.estimated_mb, budget, 'forced')
+
+    @contextmanager
+    def admit(self, width: int, height: int, num_colors: int, variants: int = 1,
+              mobile: bool = False, threads: int = 1,
+              queue_timeout: Optional[float] = None) -> Iterator[JobPlan]:
+        """
+        Admit a job, waiting for memory if necessary; releases its reservation on exit.
+
+        Raises:
+            AdmissionError: if the job could not be admitted within queue_timeout
+                (default self.queue_timeout)
+        """
+        queue_timeout = self.queue_timeout if queue_timeout is None else queue_timeout
+        start = time.monotonic()
+        while True:
+            with self.reservations.transaction() as conn:
+                reserved_mb, running = self.reservations.totals(conn)
+                plan, fallback = self.plan(width, height, num_colors, variants, mobile, threads, reserved_mb)
+                if plan is None and running == 0:
+                    # Nothing else on the box to wait for; run as small as we can
+                    plan = fallback
+                if plan is not None:
+                    reservation_id = self.reservations.add(conn, plan.estimated_mb)
+                    break
+            if time.monotonic() - start >= queue_timeout:
+                raise AdmissionError(
+                    f"Not enough memory for a {width}x{height} job "
+                    f"(needs {fallback.estimated_mb}MB, budget {fallback.budget_mb}MB)")
+            # Running jobs free memory without notifying us, so poll
+            time.sleep(self.poll_interval)
+
+        plan.queued_seconds = round(time.monotonic() - start, 2)
+        logger.info(f"Admission {plan.decision}: {width}x{height} -> {plan.max_image_size[0]}x{plan.max_image_size[1]}, "
+                    f"estimate {plan.estimated_mb}MB of {plan.budget_mb}MB budget, queued {plan.queued_seconds}s")
+
+        try:
+            yield plan
+        finally:
+            self.reservations.remove(reservation_id)
@@ -0,0 +1,213 @@
+import hashlib
+import io
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from typing import Iterator, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Longest side of the thumbnail stored with every blob
+THUMBNAIL_SIZE = 160
+THUMBNAIL_QUALITY = 80
+# Largest upload accepted, in pixels (MAX_UPLOAD_PIXELS); never above PIL's
+# decompression-bomb limit. A 50 MP upload still decodes to ~150MB for its
+# thumbnail, outside admission control
+DEFAULT_MAX_PIXELS = 50_000_000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    format TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    size_bytes INTEGER NOT NULL,
+    thumbnail BLOB,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS uploads (
+    file_id TEXT PRIMARY KEY,
+    hash TEXT NOT NULL REFERENCES blobs(hash),
+    original_name TEXT,
+    created_at REAL NOT NULL
+);
+"""
+
+# PIL format name -> extension the blob is stored under
+FORMAT_EXTENSIONS = {'PNG': 'png', 'JPEG': 'jpg', 'GIF': 'gif', 'BMP': 'bmp'}
+
+
+class ImageTooLargeError(ValueError):
+    """Raised when an upload has more pixels than the index accepts."""
+
+
+@dataclass
+class UploadRecord:
+    """Metadata of one upload and the blob it points to."""
+    file_id: str
+    hash: str
+    path: str
+    format: str
+    width: int
+    height: int
+    size_bytes: int
+    original_name: Optional[str] = None
+    duplicate: bool = False
+
+    def to_dict(self):
+        data = asdict(self)
+        del data['path']
+        return data
+
+
+def check_pixels(width: int, height: int, max_pixels: int) -> None:
+    """
+    Refuse images with more than max_pixels pixels.
+
+    Raises:
+        ImageTooLargeError: if width x height exceeds max_pixels
+    """
+    if width * height > max_pixels:
+        raise ImageTooLargeError(f"Image is {width}x{height}, larger than {max_pixels} pixels")
+
+
+def inspect_image(data: bytes, max_pixels: int = DEFAULT_MAX_PIXELS) -> Tuple[str, int, int, bytes]:
+    """
+    Read format and dimensions from an encoded image and make its thumbnail.
+
+    Returns:
+        (PIL format name, width, height, JPEG thumbnail bytes)
+
+    Raises:
+        ImageTooLargeError: if the image has more than max_pixels pixels
+        ValueError: if the bytes are not an image in a supported format
+    """
+    from PIL import Image
+
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            image_format = img.format
+            width, height = img.size
+            if image_format not in FORMAT_EXTENSIONS:
+                raise ValueError(f"Unsupported image format: {image_format}")
+            # Checked from the header, before anything is decoded
+            check_pixels(width, height, max_pixels)
+            # Shrink in place first (JPEG decodes straight at a reduced scale in
+            # draft mode) so only the small result is converted
+            img.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            thumb = img.convert('RGB')
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError(str(e))
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError(f"Not a valid image: {str(e)}")
+
+    buffer = io.BytesIO()
+    thumb.save(buffer, 'JPEG', quality=THUMBNAIL_QUALITY)
+    return image_format, width, height, buffer.getvalue()
+
+
+class UploadIndex:
+    """
+    Content-addressed upload store with a SQLite metadata index.
+
+    Uploaded bytes are stored once per SHA-256 as <hash>.<ext> in the upload
+    folder; every upload still gets its own file_id (so outputs of different
+    jobs never collide) that points at the shared blob. Format, dimensions,
+    size and a thumbnail are recorded at upload time, so later stages look a
+    file_id up by primary key instead of probing extensions and decoding.
+    """
+
+    def __init__(self, upload_folder: str, db_path: Optional[str] = None, max_pixels: Optional[int] = None):
+        from PIL import Image
+
+        self.upload_folder = upload_folder
+        self.db_path = db_path or os.path.join(upload_folder, 'index.sqlite3')
+        self.max_pixels = min(max_pixels or DEFAULT_MAX_PIXELS, Image.MAX_IMAGE_PIXELS or DEFAULT_MAX_PIXELS)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # A short-lived connection per call is safe across threads and gunicorn
+        # workers; WAL lets readers proceed while an upload is being recorded
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _blob_path(self, filename: str) -> str:
+        return os.path.join(self.upload_folder, filename)
+
+    def add(self, data: bytes, original_name: Optional[str] = None) -> UploadRecord:
+        """
+        Store uploaded bytes (once per content hash) and register a new file_id.
+
+        Raises:
+            ImageTooLargeError: if the image has more than max_pixels pixels
+            ValueError: if the bytes are not a supported image
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        file_id = str(uuid.uuid4())
+        now = time.time()
+
+        with self._connect() as conn:
+            row = conn.execute('SELECT filename, format, width, height, size_bytes FROM blobs WHERE hash = ?',
+                               (digest,)).fetchone()
+        duplicate = row is not None and os.path.exists(self._blob_path(row[0]))
+
+        if duplicate:
+            filename, image_format, width, height, size_bytes = row
+            # Blobs stored before the limit (or under a higher one) are refused too
+            check_pixels(width, height, self.max_pixels)
+        else:
+            image_format, width, height, thumbnail = inspect_image(data, self.max_pixels)
+            filename = f"{digest}.{FORMAT_EXTENSIONS[image_format]}"
+            size_bytes = len(data)
+            # Write under a temporary name and rename, so a concurrent upload of
+            # the same bytes never sees a partial file
+            temp_path = self._blob_path(f".{file_id}.tmp")
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, self._blob_path(filename))
+
+        with self._connect() as conn:
+            if not duplicate:
+                conn.execute('INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             (digest, filename, image_format, width, height, size_bytes, thumbnail, now))
+            conn.execute('INSERT INTO uploads VALUES (?, ?, ?, ?)', (file_id, digest, original_name, now))
+
+        logger.info(f"Upload {file_id} -> {filename} ({width}x{height} {image_format}, "
+                    f"{'duplicate' if duplicate else 'new'} blob)")
+        return UploadRecord(file_id, digest, self._blob_path(filename), image_format, width, height,
+                            size_bytes, original_name, duplicate)
+
+    def get(self, file_id: str) -> Optional[UploadRecord]:
+        """Look up an upload by file_id; None if it is unknown or its blob is gone."""
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT u.hash, b.filename, b.format, b.width, b.height, b.size_bytes, u.original_name '
+                'FROM uploads u JOIN blobs b ON b.hash = u.hash WHERE u.file_id = ?', (file_id,)).fetchone()
+        if row is None:
+            return None
+        digest, filename, image_format, width, height, size_bytes, original_name = row
+        path = self._blob_path(filename)
+        if not os.path.exists(path):
+            return None
+        return UploadRecord(file_id, digest, path, image_format, width, height, size_bytes, original_name)
+
+    def thumbnail(self, file_id: str) -> Optional[bytes]:
+        """JPEG thumbnail of an upload, or None if the file_id is unknown."""
+        with self._connect() as conn:
+            row = conn.execute('SELECT b.thumbnail FROM uploads u JOIN blobs b ON b.hash = u.hash '
+                               'WHERE u.file_id = ?', (file_id,)).fetchone()
+        return row[0] if row else None